@@ -1,130 +1,81 @@
-import contextlib
-import pandas as pd
 import math
 
+import numpy as np
+import pandas as pd
+
+from CohortStore import CLINICAL_COLUMNS, CohortStore
+
+
+def _int_or_none(value):
+    return None if math.isnan(value) else int(value)
+
+
+def _int_or_inf(value):
+    return math.inf if math.isinf(value) else int(value)
+
 
 class ClinicalData:
-    def __init__(self, clinical_data: pd.DataFrame):
-        self.clinical_data = clinical_data
-        self.case_submitter_id = clinical_data["case_submitter_id"]
-        is_series = isinstance(clinical_data["age_at_index"], pd.Series)
-        self.days_to_treatment_end = []
-        self.days_to_treatment_start = []
-        self.regimen_or_line_of_therapy = []
-        self.therapeutic_agents = []
-        self.treatment_type = []
-        if is_series:
-            self.age_at_index =  int(clinical_data["age_at_index"][0]) if clinical_data["age_at_index"][
-                                                                             0] != "\'--" else None
-            self.cause_of_death = clinical_data["cause_of_death"][0] if clinical_data["cause_of_death"][
-                                                                            0] != "\'--" else None
-            self.days_to_birth = int(clinical_data["days_to_birth"][0]) if clinical_data["days_to_birth"][
-                                                                               0] != "\'--" else None
-            self.days_to_death = int(clinical_data["days_to_death"][0]) if clinical_data["days_to_death"][0] != "\'--" else None
-            self.ethnicity = clinical_data["ethnicity"][0] if clinical_data["ethnicity"][0] != "\'--" else None
-            self.gender = clinical_data["gender"][0] if clinical_data["gender"][0] != "\'--" else None
-            self.race = clinical_data["race"][0] if clinical_data["race"][0] != "\'--" else None
-            self.vital_status = clinical_data["vital_status"][0] if clinical_data["vital_status"][0] != "\'--" else None
-            self.age_at_diagnosis = int(clinical_data["age_at_diagnosis"][0]) if clinical_data["age_at_diagnosis"][
-                                                                                     0] != "\'--" else None  # in days
-            self.days_to_last_follow_up = int(clinical_data["days_to_last_follow_up"][0]) if \
-                        clinical_data["days_to_last_follow_up"][0] != "\'--" else None  # in days
-            self.days_to_last_known_disease_status = int(clinical_data[
-                                                             "days_to_last_known_disease_status"][0]) if clinical_data[
-                                                                                                             "days_to_last_known_disease_status"][
-                                                                                                             0] != "\'--" else None  # in days
-            self.iss_stage = (
-                list(clinical_data["iss_stage"][0].split(","))
-                if clinical_data["iss_stage"][0] != "\'--"
-                else None
-            )
-            for day in clinical_data["days_to_treatment_end"]:
-                if day != "\'--":
-                        self.days_to_treatment_end.append(int(day))
-                else:
-                    self.days_to_treatment_end.append(math.inf)
-            for day in clinical_data["days_to_treatment_start"]:
-                if day != "\'--" and day != float("inf"):
-                    self.days_to_treatment_start.append(int(day))
-                else:
-                    self.days_to_treatment_start.append(0)
-            for regimen in clinical_data["regimen_or_line_of_therapy"]:
-                if regimen != "\'--":
-                    self.regimen_or_line_of_therapy.append(regimen)
-                else:
-                    self.regimen_or_line_of_therapy.append(None)
-            for agent in clinical_data["therapeutic_agents"]:
-                if agent != "\'--":
-                    self.therapeutic_agents.append(agent)
-                else:
-                    self.therapeutic_agents.append(None)
-            for treatment in clinical_data["treatment_type"]:
-                if treatment != "\'--":
-                    self.treatment_type.append(treatment)
-                else:
-                    self.treatment_type.append(None)
-            self.treatment_lines_data = pd.DataFrame(
-                {
-                    "regimen_or_line_of_therapy": self.regimen_or_line_of_therapy,
-                    "days_to_treatment_start": self.days_to_treatment_start,
-                    "days_to_treatment_end": self.days_to_treatment_end,
-                    "therapeutic_agents": self.therapeutic_agents,
-                    "treatment_type": self.treatment_type,
-                }
-            )
-            self.treatment_lines_data = self.treatment_lines_data.sort_values(
-                ["days_to_treatment_start", "days_to_treatment_end"]
-            )
+    def __init__(self, store: CohortStore, case_idx: int):
+        # The store holds the columns already parsed by DataPreprocess.parse_clinical_data
+        rows = slice(store.clinical_offsets[case_idx], store.clinical_offsets[case_idx + 1])
+        columns = {column: values[rows] for column, values in store.clinical_columns.items()}
+        self.case_id = store.cases[case_idx]
+        self._columns = columns
+        self.age_at_index = _int_or_none(columns["age_at_index"][0])
+        self.cause_of_death = columns["cause_of_death"][0]
+        self.days_to_birth = _int_or_none(columns["days_to_birth"][0])
+        self.days_to_death = _int_or_none(columns["days_to_death"][0])
+        self.ethnicity = columns["ethnicity"][0]
+        self.gender = columns["gender"][0]
+        self.race = columns["race"][0]
+        self.vital_status = columns["vital_status"][0]
+        self.age_at_diagnosis = _int_or_none(columns["age_at_diagnosis"][0])  # in days
+        self.days_to_last_follow_up = _int_or_none(columns["days_to_last_follow_up"][0])  # in days
+        self.days_to_last_known_disease_status = _int_or_none(
+            columns["days_to_last_known_disease_status"][0])  # in days
+        self.iss_stage = list(columns["iss_stage"][0]) if columns["iss_stage"][0] is not None else None
+        self.days_to_treatment_end = [_int_or_inf(day) for day in columns["days_to_treatment_end"].tolist()]
+        self.days_to_treatment_start = columns["days_to_treatment_start"].tolist()
+        self.regimen_or_line_of_therapy = columns["regimen_or_line_of_therapy"].tolist()
+        self.therapeutic_agents = columns["therapeutic_agents"].tolist()
+        self.treatment_type = columns["treatment_type"].tolist()
+
+        # Treatment lines sorted by start and end day, as NumPy columns
+        self.treatment_lines_order = store.clinical_line_order[rows]
+        self.line_regimens = columns["regimen_or_line_of_therapy"][self.treatment_lines_order]
+        self.line_starts = columns["days_to_treatment_start"][self.treatment_lines_order]
+        self.line_ends = columns["days_to_treatment_end"][self.treatment_lines_order]
+        self.line_agents = columns["therapeutic_agents"][self.treatment_lines_order]
+        self.line_treatment_types = columns["treatment_type"][self.treatment_lines_order]
+
+    @property
+    def clinical_data(self):
+        """ The clinical rows of the case indexed by case_id, built on demand: a pd.DataFrame, or a pd.Series when
+        the case has a single row, as clinical_df.loc[case_id] is. The values are the parsed ones of the store.
+        """
+        clinical_data = pd.DataFrame({column: self._columns[column] for column in CLINICAL_COLUMNS},
+                                     index=pd.Index([self.case_id] * len(self.line_regimens), name="case_id"))
+        return clinical_data.iloc[0] if len(clinical_data) == 1 else clinical_data
 
-        else:
-            self.age_at_index = int(clinical_data["age_at_index"]) if clinical_data["age_at_index"] != "\'--" else None
-            self.cause_of_death = clinical_data["cause_of_death"] if clinical_data["cause_of_death"] !=  "\'--" else None
-            self.days_to_birth = int(clinical_data["days_to_birth"]) if clinical_data[
-                                                                            "days_to_birth"] != "\'--" else None
-            self.days_to_death = int(clinical_data["days_to_death"]) if clinical_data["days_to_death"] != "\'--" else None
-            self.ethnicity = clinical_data["ethnicity"] if clinical_data["ethnicity"] != "\'--" else None
-            self.gender = clinical_data["gender"] if clinical_data["gender"] != "\'--" else None
-            self.race = clinical_data["race"] if clinical_data["race"] != "\'--" else None
-            self.vital_status = clinical_data["vital_status"] if clinical_data["vital_status"] != "\'--" else None
-            self.age_at_diagnosis = int(clinical_data["age_at_diagnosis"]) if clinical_data["age_at_diagnosis"] \
-                                                                                          != "\'--" else None  # in days
-            self.days_to_last_follow_up = int(clinical_data["days_to_last_follow_up"]) if \
-                        clinical_data["days_to_last_follow_up"] != "\'--" else None
+    @property
+    def case_submitter_id(self):
+        return self.clinical_data["case_submitter_id"]
 
-            self.days_to_last_known_disease_status = int(clinical_data[
-                                                             "days_to_last_known_disease_status"]) if clinical_data[
-                                                                                                          "days_to_last_known_disease_status"] != "\'--" else None
-            self.iss_stage = (
-                list(clinical_data["iss_stage"].split(","))
-                if clinical_data["iss_stage"] != "\'--"
-                else None
-            )
-            if clinical_data["days_to_treatment_end"] != "\'--":
-                self.days_to_treatment_end.append(int(clinical_data["days_to_treatment_end"]))
-            else:
-                self.days_to_treatment_end.append(math.inf)
-            if clinical_data["days_to_treatment_start"] not in ["\'--", "inf"]:
-                self.days_to_treatment_start.append(int(clinical_data["days_to_treatment_start"]))
-            else:
-                self.days_to_treatment_start.append(0)
-            if clinical_data["regimen_or_line_of_therapy"] != "\'--":
-                self.regimen_or_line_of_therapy.append(clinical_data["regimen_or_line_of_therapy"])
-            else:
-                self.regimen_or_line_of_therapy.append(None)
-            if clinical_data["therapeutic_agents"][0] != "\'--":
-                self.therapeutic_agents.append(clinical_data["therapeutic_agents"])
-            else:
-                self.therapeutic_agents.append(None)
-            if clinical_data["treatment_type"] != "\'--":
-                self.treatment_type.append(clinical_data["treatment_type"])
-            else:
-                self.treatment_type.append(None)
-            self.treatment_lines_data = pd.DataFrame(
-                {
-                    "regimen_or_line_of_therapy": self.regimen_or_line_of_therapy,
-                    "days_to_treatment_start": self.days_to_treatment_start,
-                    "days_to_treatment_end": self.days_to_treatment_end,
-                    "therapeutic_agents": self.therapeutic_agents,
-                    "treatment_type": self.treatment_type,
-                }
-            )
+    @property
+    def treatment_lines_data(self) -> pd.DataFrame:
+        """ The treatment lines sorted by days_to_treatment_start and days_to_treatment_end, built on demand.
+        days_to_treatment_end holds integers unless a line has not ended (inf).
+        """
+        line_ends = self.line_ends
+        if np.isfinite(line_ends).all():
+            line_ends = line_ends.astype(np.int64)
+        return pd.DataFrame(
+            {
+                "regimen_or_line_of_therapy": self.line_regimens,
+                "days_to_treatment_start": self.line_starts,
+                "days_to_treatment_end": line_ends,
+                "therapeutic_agents": self.line_agents,
+                "treatment_type": self.line_treatment_types,
+            },
+            index=self.treatment_lines_order,
+        )
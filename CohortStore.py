@@ -0,0 +1,308 @@
+"""
+This file holds the cohort store that the Patient, ClinicalData and FollowUp classes are views over.
+The clinical and follow-ups tables are split by case once for the whole cohort, into NumPy columns plus
+per-case and per-follow-up offset arrays, so building a patient only slices arrays.
+# rows of case i:
+clinical rows: clinical_offsets[i]:clinical_offsets[i + 1]
+follow-ups: follow_up_case_offsets[i]:follow_up_case_offsets[i + 1]
+# rows of follow-up j:
+follow_up_offsets[j]:follow_up_offsets[j + 1]
+# binary copy (CohortStore.save), every array is a .npy file memory-mapped by CohortStore.load:
+{path}/metadata.json - case ids, marker, unit and clinical string vocabularies, and the source files it was built from
+{path}/{attribute}.npy - the arrays of ARRAY_ATTRIBUTES
+{path}/clinical_{column}.npy - numeric clinical columns, and codes into the vocabulary for the string columns
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from DataPreprocess import parse_clinical_data
+
+CLINICAL_COLUMNS = ["case_submitter_id", "age_at_index", "cause_of_death", "days_to_birth", "days_to_death",
+                    "ethnicity", "gender", "race", "vital_status", "age_at_diagnosis", "days_to_last_follow_up",
+                    "days_to_last_known_disease_status", "iss_stage", "days_to_treatment_end",
+                    "days_to_treatment_start", "regimen_or_line_of_therapy", "therapeutic_agents", "treatment_type"]
+ARRAY_ATTRIBUTES = ["clinical_offsets", "clinical_line_order", "follow_up_ids", "follow_up_days", "follow_up_offsets",
+                    "follow_up_case_offsets", "marker_codes", "unit_codes", "test_values", "heights", "weights",
+                    "is_first_marker_row", "follow_up_values", "follow_up_has_marker"]
+STORE_VERSION = 1  # bump when the binary copy changes, so older copies are rebuilt from the CSV files
+
+
+def _unit_or_empty(unit) -> str:
+    return "" if pd.isna(unit) else str(unit)
+
+
+def get_n_jobs(n_jobs: Optional[int]) -> int:
+    """ Returns the number of worker processes to use, None or a negative n_jobs meaning one per core.
+    """
+    if n_jobs is None or n_jobs < 0:
+        return os.cpu_count() or 1
+    return max(n_jobs, 1)
+
+
+def map_store_chunks(function: Callable, store: "CohortStore", n_jobs: Optional[int], *args) -> list:
+    """ Returns [function(chunk, *args) for chunk in store.split(n_jobs)], computed in n_jobs worker processes.
+    The results are in case order whatever the number of workers, and n_jobs=1 runs function(store, *args) serially.
+    function must be picklable, i.e. defined at the top level of a module.
+    """
+    n_jobs = get_n_jobs(n_jobs)
+    if n_jobs == 1 or len(store) <= 1:
+        return [function(store, *args)]
+    chunks = store.split(n_jobs)
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        return list(executor.map(function, chunks, *[[arg] * len(chunks) for arg in args]))
+
+
+def get_cases(clinical_df: pd.DataFrame, follow_ups_df: pd.DataFrame) -> List[str]:
+    """ Returns the cases of the clinical table that have follow-ups, in clinical table order.
+    """
+    follow_ups_cases = set(follow_ups_df["Case ID"].unique())
+    return [case for case in clinical_df["case_id"].unique() if case in follow_ups_cases]
+
+
+def get_source_stats(paths: List[str]) -> List[List[int]]:
+    """ Returns the size and modification time of each file, which tell whether a binary copy is out of date.
+    """
+    return [[os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in paths]
+
+
+def load_cohort_store(clinical_data_path: str, follow_ups_data_path: str,
+                      store_path: Optional[str] = None) -> "CohortStore":
+    """ Returns the store of the given files, from the binary copy at store_path when it was saved from them
+    and otherwise parsed from the CSV files.
+    """
+    if store_path is not None and CohortStore.is_saved_from(store_path, [clinical_data_path, follow_ups_data_path]):
+        return CohortStore.load(store_path)
+    return CohortStore(pd.read_csv(clinical_data_path), pd.read_csv(follow_ups_data_path))
+
+
+def _ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """ Returns the concatenation of range(start, start + length) for every start and length.
+    """
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return offsets + np.arange(total)
+
+
+class CohortStore:
+    def __init__(self, clinical_df: pd.DataFrame, follow_ups_df: pd.DataFrame, cases: Optional[List[str]] = None):
+        if cases is None:
+            cases = get_cases(clinical_df, follow_ups_df)
+        self.cases = np.asarray(cases, dtype=object)
+        self.case_index: Dict[str, int] = {case: idx for idx, case in enumerate(self.cases)}
+        self._init_clinical_data(clinical_df)
+        self._init_follow_ups_data(follow_ups_df)
+
+    @classmethod
+    def from_patient_frames(cls, clinical_data, follow_ups_data, case_id: str) -> "CohortStore":
+        """ Builds a single-case store from the clinical_df.loc[case_id] and follow_ups_df.loc[case_id] slices.
+        clinical_data is a pd.Series when the case has a single treatment row.
+        """
+        if isinstance(clinical_data, pd.Series):
+            clinical_data = clinical_data.to_frame().T
+        clinical_data = clinical_data.reset_index(drop=True).assign(case_id=case_id)
+        follow_ups_data = follow_ups_data.reset_index(drop=True).assign(**{"Case ID": case_id})
+        return cls(clinical_data, follow_ups_data, [case_id])
+
+    def __len__(self) -> int:
+        return len(self.cases)
+
+    def subset(self, start: int, stop: int) -> "CohortStore":
+        """ Returns a store of the cases start:stop, sharing the marker vocabulary. The arrays are slices of this store.
+        """
+        store = CohortStore.__new__(CohortStore)
+        store.cases = self.cases[start:stop]
+        store.case_index = {case: idx for idx, case in enumerate(store.cases)}
+        clinical_rows = slice(self.clinical_offsets[start], self.clinical_offsets[stop])
+        store.clinical_offsets = self.clinical_offsets[start:stop + 1] - self.clinical_offsets[start]
+        store.clinical_columns = {column: values[clinical_rows] for column, values in self.clinical_columns.items()}
+        store.clinical_line_order = self.clinical_line_order[clinical_rows]
+
+        store.markers, store.units, store.marker_index = self.markers, self.units, self.marker_index
+        store.marker_units = self.marker_units
+        follow_ups = slice(self.follow_up_case_offsets[start], self.follow_up_case_offsets[stop])
+        rows = slice(self.follow_up_offsets[follow_ups.start], self.follow_up_offsets[follow_ups.stop])
+        store.follow_up_ids = self.follow_up_ids[follow_ups]
+        store.follow_up_days = self.follow_up_days[follow_ups]
+        store.follow_up_offsets = self.follow_up_offsets[follow_ups.start:follow_ups.stop + 1] - rows.start
+        store.follow_up_case_offsets = self.follow_up_case_offsets[start:stop + 1] - follow_ups.start
+        store.marker_codes = self.marker_codes[rows]
+        store.unit_codes = self.unit_codes[rows]
+        store.test_values = self.test_values[rows]
+        store.heights = self.heights[start:stop]
+        store.weights = self.weights[start:stop]
+        store.is_first_marker_row = self.is_first_marker_row[rows]
+        store.follow_up_values = self.follow_up_values[follow_ups]
+        store.follow_up_has_marker = self.follow_up_has_marker[follow_ups]
+        return store
+
+    def split(self, n_chunks: int) -> List["CohortStore"]:
+        """ Returns the store split into at most n_chunks stores of consecutive cases.
+        """
+        bounds = np.linspace(0, len(self), min(n_chunks, len(self)) + 1).astype(int)
+        return [self.subset(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def save(self, path: str, sources: Optional[List[str]] = None):
+        """ Writes the store as a directory of .npy files, see the layout above.
+        sources are the files the store was built from, recorded so that is_saved_from can tell when they change.
+        """
+        os.makedirs(path, exist_ok=True)
+        metadata = {
+            "version": STORE_VERSION,
+            "sources": get_source_stats(sources) if sources is not None else None,
+            "cases": self.cases.tolist(),
+            "markers": self.markers.tolist(),
+            "units": self.units.tolist(),
+            "marker_units": self.marker_units.tolist(),
+            "clinical_vocabularies": {},
+        }
+        for attribute in ARRAY_ATTRIBUTES:
+            values = getattr(self, attribute)
+            if values.dtype == object:
+                values = values.astype(str)
+            np.save(os.path.join(path, f"{attribute}.npy"), values)
+        for column, values in self.clinical_columns.items():
+            if values.dtype == object:
+                if column == "iss_stage":
+                    values = np.array([",".join(stages) if stages is not None else None for stages in values],
+                                      dtype=object)
+                # None is missing and gets the code -1
+                codes, vocabulary = pd.factorize(values)
+                metadata["clinical_vocabularies"][column] = vocabulary.tolist()
+                values = codes.astype(np.int32)
+            np.save(os.path.join(path, f"clinical_{column}.npy"), values)
+        with open(os.path.join(path, "metadata.json"), "w") as file:
+            json.dump(metadata, file)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = "r") -> "CohortStore":
+        """ Reads a store written by save. The arrays are memory-mapped, except for the clinical string columns
+        which are decoded from their codes.
+        """
+        with open(os.path.join(path, "metadata.json")) as file:
+            metadata = json.load(file)
+        store = cls.__new__(cls)
+        store.cases = np.asarray(metadata["cases"], dtype=object)
+        store.case_index = {case: idx for idx, case in enumerate(store.cases)}
+        store.markers = np.asarray(metadata["markers"], dtype=object)
+        store.units = np.asarray(metadata["units"], dtype=object)
+        store.marker_units = np.asarray(metadata["marker_units"], dtype=object)
+        store.marker_index = {marker: idx for idx, marker in enumerate(store.markers)}
+        for attribute in ARRAY_ATTRIBUTES:
+            setattr(store, attribute, np.load(os.path.join(path, f"{attribute}.npy"), mmap_mode=mmap_mode))
+        store.clinical_columns = {}
+        for column in CLINICAL_COLUMNS:
+            values = np.load(os.path.join(path, f"clinical_{column}.npy"), mmap_mode=mmap_mode)
+            if column in metadata["clinical_vocabularies"]:
+                # Code -1 indexes the trailing None
+                vocabulary = np.empty(len(metadata["clinical_vocabularies"][column]) + 1, dtype=object)
+                for code, value in enumerate(metadata["clinical_vocabularies"][column]):
+                    vocabulary[code] = value.split(",") if column == "iss_stage" else value
+                values = vocabulary[values]
+            store.clinical_columns[column] = values
+        return store
+
+    @staticmethod
+    def is_saved_from(path: str, sources: List[str]) -> bool:
+        """ Returns whether path holds a binary copy of the current format saved from the current sources.
+        """
+        metadata_path = os.path.join(path, "metadata.json")
+        if not os.path.exists(metadata_path):
+            return False
+        with open(metadata_path) as file:
+            metadata = json.load(file)
+        return metadata["version"] == STORE_VERSION and metadata["sources"] == get_source_stats(sources)
+
+    def _init_clinical_data(self, clinical_df: pd.DataFrame):
+        case_pos = clinical_df["case_id"].map(self.case_index).to_numpy()
+        keep = ~pd.isna(case_pos)
+        case_pos = case_pos[keep].astype(np.int64)
+        clinical_df = parse_clinical_data(clinical_df[keep])
+        # Stable, so the rows of every case keep their order in the file
+        order = np.argsort(case_pos, kind="stable")
+        case_pos = case_pos[order]
+        self.clinical_offsets = np.searchsorted(case_pos, np.arange(len(self.cases) + 1))
+        self.clinical_columns = {
+            column: clinical_df[column].to_numpy()[order] for column in CLINICAL_COLUMNS
+        }
+        # Position of each case's treatment lines when sorted by start and end day, relative to the case's first row
+        line_order = np.lexsort((self.clinical_columns["days_to_treatment_end"],
+                                 self.clinical_columns["days_to_treatment_start"], case_pos))
+        self.clinical_line_order = line_order - self.clinical_offsets[case_pos]
+
+    def _init_follow_ups_data(self, follow_ups_df: pd.DataFrame):
+        marker_codes, markers = pd.factorize(follow_ups_df["Laboratory Test"], use_na_sentinel=False)
+        unit_codes, units = pd.factorize(follow_ups_df["Test Units"], use_na_sentinel=False)
+        self.markers = np.asarray(markers, dtype=object)
+        self.units = np.asarray(units, dtype=object)
+        self.marker_index: Dict[str, int] = {marker: idx for idx, marker in enumerate(self.markers)}
+        # The unit of the first row of every marker in the file, aligned to self.markers
+        self.marker_units = self.units[unit_codes[np.unique(marker_codes, return_index=True)[1]]]
+
+        case_pos = follow_ups_df["Case ID"].map(self.case_index).to_numpy()
+        keep = ~pd.isna(case_pos)
+        case_pos = case_pos[keep].astype(np.int64)
+        follow_up_ids = follow_ups_df["Follow-Up"].to_numpy()[keep]
+        days = follow_ups_df["Days to Follow-Up"].to_numpy()[keep]
+        id_rank = pd.factorize(follow_up_ids, sort=True)[0]
+
+        # Group the rows by (case, follow-up id), keeping the file order inside each follow-up
+        group_order = np.lexsort((id_rank, case_pos))
+        new_group = np.ones(len(group_order), dtype=bool)
+        new_group[1:] = (np.diff(case_pos[group_order]) != 0) | (np.diff(id_rank[group_order]) != 0)
+        group_starts = np.flatnonzero(new_group)
+        group_lengths = np.diff(np.append(group_starts, len(group_order)))
+        first_rows = group_order[group_starts]
+
+        # Follow-ups of each case are sorted by days to follow-up, ties broken by follow-up id
+        follow_up_order = np.lexsort((id_rank[first_rows], days[first_rows], case_pos[first_rows]))
+        rows = group_order[_ranges(group_starts[follow_up_order], group_lengths[follow_up_order])]
+
+        follow_up_rows = first_rows[follow_up_order]
+        self.follow_up_ids = follow_up_ids[follow_up_rows]
+        self.follow_up_days = days[follow_up_rows].astype(np.int64)
+        self.follow_up_offsets = np.concatenate(([0], np.cumsum(group_lengths[follow_up_order])))
+        self.follow_up_case_offsets = np.searchsorted(case_pos[follow_up_rows], np.arange(len(self.cases) + 1))
+
+        self.marker_codes = marker_codes[keep][rows]
+        self.unit_codes = unit_codes[keep][rows]
+        self.test_values = follow_ups_df["Test Value"].to_numpy(dtype=np.float64)[keep][rows]
+        heights = follow_ups_df["Patient Height"].to_numpy()[keep][rows]
+        weights = follow_ups_df["Patient Weight"].to_numpy()[keep][rows]
+        case_rows = self.follow_up_offsets[self.follow_up_case_offsets[:-1]]
+        has_rows = np.diff(self.follow_up_case_offsets) > 0
+        self.heights = np.zeros(len(self.cases), dtype=np.int64)
+        self.weights = np.zeros(len(self.cases), dtype=np.int64)
+        self.heights[has_rows] = heights[case_rows[has_rows]]
+        self.weights[has_rows] = weights[case_rows[has_rows]]
+
+        # The first row of every marker inside a follow-up, which is the value a follow-up reports
+        row_follow_up = np.repeat(np.arange(len(self.follow_up_ids)), np.diff(self.follow_up_offsets))
+        first_marker_rows = np.unique(row_follow_up * len(self.markers) + self.marker_codes, return_index=True)[1]
+        self.is_first_marker_row = np.zeros(len(rows), dtype=bool)
+        self.is_first_marker_row[first_marker_rows] = True
+
+        # Follow-ups x markers index of those values, aligned to self.markers. NaN where the follow-up lacks the marker.
+        self.follow_up_values = np.full((len(self.follow_up_ids), len(self.markers)), np.nan)
+        self.follow_up_has_marker = np.zeros((len(self.follow_up_ids), len(self.markers)), dtype=bool)
+        self.follow_up_values[row_follow_up[first_marker_rows], self.marker_codes[first_marker_rows]] = \
+            self.test_values[first_marker_rows]
+        self.follow_up_has_marker[row_follow_up[first_marker_rows], self.marker_codes[first_marker_rows]] = True
+
+    def get_marker_indices(self, markers: List[str]) -> np.ndarray:
+        """ Returns the column of each marker in self.follow_up_values, -1 for markers that never appear in the cohort.
+        """
+        return np.array([self.marker_index.get(marker, -1) for marker in markers], dtype=np.int64)
+
+    def get_marker_units(self, markers: List[str]) -> List[str]:
+        """ Returns the unit of each marker in self.marker_units, "" for markers that never appear in the cohort or
+        have no unit.
+        """
+        return [_unit_or_empty(self.marker_units[idx]) if idx >= 0 else "" for idx in self.get_marker_indices(markers)]
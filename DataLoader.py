@@ -7,36 +7,94 @@ case_id	case_submitter_id	age_at_index	cause_of_death	days_to_birth	days_to_deat
 Case ID	Follow-Up	Days to Follow-Up	Laboratory Test	Test Value	Test Units	Patient Height	Patient Weight
 """
 
-from typing import Tuple
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional, Tuple
+import numpy as np
 import pandas as pd
 from torch.utils.data import Dataset, DataLoader
 from torch.utils.data import random_split
+from CohortStore import CohortStore, map_store_chunks
 from Patient import Patient
 
 
+def _map_patients(store: CohortStore, function: Callable) -> list:
+    return [function(Patient(store, idx)) for idx in range(len(store))]
+
+
 class ClinicalDataset(Dataset):
-    def __init__(self, clinical_data_path: str, follow_ups_data_path: str):
-        self.clinical_df = pd.read_csv(clinical_data_path)
-        self.follow_ups_df = pd.read_csv(follow_ups_data_path)
-        self.cases = self.clinical_df["case_id"].unique()
-        self.follow_ups = self.follow_ups_df["Follow-Up"].unique()
-        self.markers = self.follow_ups_df["Laboratory Test"].unique()
-        self.marker_units_dict = {
-            marker: self.follow_ups_df[self.follow_ups_df["Laboratory Test"] == marker]["Test Units"].unique()[0]
-            for marker in self.markers
-        }
-        self.cases = [case for case in self.cases if case in self.follow_ups_df["Case ID"].unique()]
-        self.clinical_df.set_index("case_id", inplace=True)
-        self.follow_ups_df.set_index("Case ID", inplace=True)
+    def __init__(self, clinical_data_path: str, follow_ups_data_path: str, cache_size: int = 1024,
+                 store_path: Optional[str] = "cohort_store"):
+        self.clinical_data_path = clinical_data_path
+        self.follow_ups_data_path = follow_ups_data_path
+        if store_path is not None and CohortStore.is_saved_from(store_path, [clinical_data_path, follow_ups_data_path]):
+            # The binary copy written by DataPreprocess.py, the CSV files are only read if the tables are accessed
+            self.store = CohortStore.load(store_path)
+            self._clinical_df = None
+            self._follow_ups_df = None
+            self._follow_ups = None
+        else:
+            clinical_df = pd.read_csv(clinical_data_path)
+            follow_ups_df = pd.read_csv(follow_ups_data_path)
+            self._follow_ups = follow_ups_df["Follow-Up"].unique()
+            self.store = CohortStore(clinical_df, follow_ups_df)
+            self._clinical_df = clinical_df.set_index("case_id")
+            self._follow_ups_df = follow_ups_df.set_index("Case ID")
+        self.cases = self.store.cases.tolist()
+        self.markers = self.store.markers
+        self.marker_units_dict = dict(zip(self.store.markers, self.store.marker_units))
+        # Patients are built on first access and kept in a least-recently-used cache of cache_size patients
+        self.cache_size = cache_size
+        self._patients = OrderedDict()
+
+    @property
+    def clinical_df(self) -> pd.DataFrame:
+        if self._clinical_df is None:
+            self._clinical_df = pd.read_csv(self.clinical_data_path).set_index("case_id")
+        return self._clinical_df
+
+    @property
+    def follow_ups_df(self) -> pd.DataFrame:
+        if self._follow_ups_df is None:
+            self._follow_ups_df = pd.read_csv(self.follow_ups_data_path).set_index("Case ID")
+        return self._follow_ups_df
+
+    @property
+    def follow_ups(self) -> np.ndarray:
+        """ The unique follow-up ids of the follow-ups file in file order, read from its "Follow-Up" column alone when
+        the dataset was loaded from the binary copy.
+        """
+        if self._follow_ups is None:
+            self._follow_ups = pd.read_csv(self.follow_ups_data_path, usecols=["Follow-Up"])["Follow-Up"].unique()
+        return self._follow_ups
 
     def __len__(self) -> int:
         return len(self.cases)
 
     def __getitem__(self, idx: int) -> Patient:
-        case_id = self.cases[idx]
-        clinical_data = self.clinical_df.loc[case_id]
-        follow_ups_data = self.follow_ups_df.loc[case_id]
-        return Patient(clinical_data, follow_ups_data, case_id)
+        if idx < 0:
+            idx += len(self)
+        if idx in self._patients:
+            self._patients.move_to_end(idx)
+            return self._patients[idx]
+        patient = Patient(self.store, idx)
+        if self.cache_size > 0:
+            self._patients[idx] = patient
+            if len(self._patients) > self.cache_size:
+                self._patients.popitem(last=False)
+        return patient
+
+    def prefetch(self, indices: Iterable[int]):
+        """ Builds the patients of the given indices ahead of their access, as far as the cache holds them.
+        """
+        for idx in indices:
+            self[idx]
+
+    def map_patients(self, function: Callable, n_jobs: Optional[int] = 1) -> list:
+        """ Returns [function(patient) for patient in self], with chunks of cases processed in n_jobs worker processes.
+        The results are in case order. n_jobs=None uses one process per core and n_jobs=1 runs serially.
+        function must be picklable, i.e. defined at the top level of a module.
+        """
+        return [result for chunk in map_store_chunks(_map_patients, self.store, n_jobs, function) for result in chunk]
 
     def get_dataloader(self, batch_size: int = 1, shuffle: bool = True) -> DataLoader:
         return DataLoader(self, batch_size=batch_size, shuffle=shuffle)
@@ -1,10 +1,21 @@
 """
 This file is used to preprocess the clinical.tsv file.
 It sorts the data by case_id and then by days_to_treatment_start
+It also holds the parsing of the clinical table into typed columns, which is done once per table at load time,
+and writes the binary copy of the clinical and follow-ups tables that the entry points load instead of the CSV files.
 """
 
+import os
+
+import numpy as np
 import pandas as pd
 
+SENTINEL = "\'--"
+INT_COLUMNS = ["age_at_index", "days_to_birth", "days_to_death", "age_at_diagnosis", "days_to_last_follow_up",
+               "days_to_last_known_disease_status"]
+STR_COLUMNS = ["case_submitter_id", "cause_of_death", "ethnicity", "gender", "race", "vital_status",
+               "regimen_or_line_of_therapy", "therapeutic_agents", "treatment_type"]
+
 
 def preprocess_clinical_data(clinical_data_path, output_path):
     clinical_df = pd.read_csv(clinical_data_path, sep="\t")
@@ -18,7 +29,37 @@ def preprocess_clinical_data(clinical_data_path, output_path):
     clinical_df.to_csv(output_path, index=False)
 
 
+def parse_clinical_data(clinical_df: pd.DataFrame) -> pd.DataFrame:
+    """ Returns a copy of the clinical table with typed columns, "'--" is the missing-value sentinel.
+    Integer columns become float64 with NaN for missing values, string columns hold None for missing values
+    and iss_stage holds lists of stages.
+    days_to_treatment_end is inf and days_to_treatment_start is 0 when missing.
+    """
+    clinical_df = clinical_df.copy()
+    for column in INT_COLUMNS + ["days_to_treatment_end", "days_to_treatment_start"]:
+        clinical_df[column] = pd.to_numeric(clinical_df[column].replace(SENTINEL, np.nan)).astype(np.float64)
+    for column in STR_COLUMNS + ["iss_stage"]:
+        values = clinical_df[column].to_numpy(dtype=object)
+        clinical_df[column] = np.where(values == SENTINEL, None, values)
+    clinical_df["iss_stage"] = clinical_df["iss_stage"].str.split(",").where(clinical_df["iss_stage"].notna(), None)
+    clinical_df["days_to_treatment_end"] = clinical_df["days_to_treatment_end"].fillna(np.inf)
+    days_to_treatment_start = clinical_df["days_to_treatment_start"].to_numpy()
+    clinical_df["days_to_treatment_start"] = np.where(
+        np.isfinite(days_to_treatment_start), days_to_treatment_start, 0).astype(np.int64)
+    return clinical_df
+
+
+def write_cohort_store(clinical_data_path, follow_ups_data_path, output_path):
+    """ Writes the binary copy of the two tables to output_path, see CohortStore.save.
+    """
+    # Imported here since CohortStore imports this module
+    from CohortStore import CohortStore
+    store = CohortStore(pd.read_csv(clinical_data_path), pd.read_csv(follow_ups_data_path))
+    store.save(output_path, sources=[clinical_data_path, follow_ups_data_path])
+
 
 if __name__ == '__main__':
     preprocess_clinical_data("clinical.tsv", "clinical_sorted.csv")
+    if os.path.exists("follow_ups_data.csv"):
+        write_cohort_store("clinical_sorted.csv", "follow_ups_data.csv", "cohort_store")
 
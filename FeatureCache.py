@@ -0,0 +1,194 @@
+"""
+This file is used to cache the X, T, Y arrays extracted by FeatureExtraction.extract_samples.
+Cache entries are content-addressed: the key hashes the input files (or, per patient, the rows of the case)
+together with the extraction configuration, so a matching entry is loaded instead of recomputed.
+# cache layout:
+{cache_dir}/{key}.npz - the arrays of all cases, see save_samples
+{cache_dir}/patients/{key}.npz - the arrays of one case
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from CohortStore import CohortStore, get_cases
+from FeatureExtraction import concatenate_samples, extract_samples, extract_samples_streamed
+from FeatureMatrix import FeatureMatrix
+from treatment_sets import pack_treatments, unpack_treatments
+
+CACHE_VERSION = 1  # bump when the extraction changes, to invalidate the existing entries
+
+
+def get_file_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def get_config_hash(features: List[str], treatments: List[str], feature2range: Optional[Dict[str, List[float]]],
+                    require_all_features: bool, outcome: str) -> str:
+    config = {
+        "version": CACHE_VERSION,
+        "features": features,
+        "treatments": treatments,
+        "feature2range": feature2range,
+        "require_all_features": require_all_features,
+        "outcome": outcome,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def get_case_hashes(df: pd.DataFrame, case_column: str) -> Dict[str, bytes]:
+    """ Returns the digest of the rows of every case, in file order.
+    """
+    if len(df) == 0:
+        return {}
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    cases = df[case_column].to_numpy()
+    order = np.argsort(cases, kind="stable")
+    cases, row_hashes = cases[order], row_hashes[order]
+    starts = np.flatnonzero(np.append(True, cases[1:] != cases[:-1]))
+    stops = np.append(starts[1:], len(cases))
+    return {
+        cases[start]: hashlib.sha256(row_hashes[start:stop].tobytes()).digest() for start, stop in zip(starts, stops)
+    }
+
+
+def save_samples(path: str, X: Union[np.ndarray, FeatureMatrix], T: np.ndarray, Y: np.ndarray):
+    """ Saves the X, T, Y arrays to an npz file, with the multi-hot rows of T packed 8 treatments to a byte
+    (see treatment_sets.pack_treatments) as T_packed and the number of treatments as n_treatments.
+    A FeatureMatrix X is saved as its arrays, X_continuous, X_codes and X_schema.
+    """
+    arrays = {"X": X} if not isinstance(X, FeatureMatrix) else {
+        f"X_{name}": array for name, array in X.get_arrays().items()
+    }
+    if T.ndim == 2:
+        np.savez(path, **arrays, T_packed=pack_treatments(T), n_treatments=T.shape[1], Y=Y)
+    else:  # no samples, so no number of treatments
+        np.savez(path, **arrays, T=T, Y=Y)
+
+
+def load_samples(path: str, packed: bool = False, compact: bool = True
+                 ) -> Tuple[Union[np.ndarray, FeatureMatrix], np.ndarray, np.ndarray]:
+    """ Returns the X, T, Y arrays of an npz file of save_samples, or of an earlier one with a dense T.
+    T is the float multi-hot matrix, or with packed its pack_treatments rows (see treatment_sets.TreatmentSets).
+    X is the FeatureMatrix it was saved as, to expand when a model is fitted on it, or with compact=False the float
+    matrix (X is the float matrix if it was not saved as a FeatureMatrix).
+    """
+    npzfile = np.load(path)
+    if "X_schema" in npzfile:
+        X = FeatureMatrix.from_arrays(npzfile["X_continuous"], npzfile["X_codes"], npzfile["X_schema"])
+        if not compact:
+            X = X.to_array()
+    else:
+        X = npzfile["X"]
+    if "T_packed" in npzfile:
+        T = npzfile["T_packed"]
+        if not packed:
+            T = unpack_treatments(T, int(npzfile["n_treatments"]), dtype=np.float64)
+    else:
+        T = npzfile["T"]
+        if packed and T.ndim == 2:
+            T = pack_treatments(T)
+    return X, T, npzfile["Y"]
+
+
+def _save_samples(path: str, samples: Tuple[np.ndarray, ...]):
+    save_samples(path, *samples)
+
+
+def _load_samples(path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    return load_samples(path, compact=False)
+
+
+def _extract_all_samples(clinical_data_path: str, follow_ups_data_path: str, features: List[str],
+                         treatments: List[str], feature2range: Optional[Dict[str, List[float]]],
+                         require_all_features: bool, outcome: str, n_jobs: Optional[int], store_path: Optional[str],
+                         chunksize: Optional[int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    if store_path is not None and CohortStore.is_saved_from(store_path, [clinical_data_path, follow_ups_data_path]):
+        store = CohortStore.load(store_path)
+    elif chunksize is not None:
+        return extract_samples_streamed(clinical_data_path, follow_ups_data_path, features, treatments, feature2range,
+                                        require_all_features, outcome, n_jobs, chunksize=chunksize)
+    else:
+        store = CohortStore(pd.read_csv(clinical_data_path), pd.read_csv(follow_ups_data_path))
+    return extract_samples(store, features, treatments, feature2range, require_all_features, outcome, n_jobs)
+
+
+def get_marker_units(clinical_data_path: str, follow_ups_data_path: str, markers: List[str],
+                     store_path: Optional[str] = None) -> List[str]:
+    """ Returns the unit of each marker like CohortStore.get_marker_units, "" for markers that are not in the cohort.
+    Reads the binary copy at store_path when it is up to date, and otherwise only the marker and unit columns of the
+    follow-ups file.
+    """
+    if store_path is not None and CohortStore.is_saved_from(store_path, [clinical_data_path, follow_ups_data_path]):
+        return CohortStore.load(store_path).get_marker_units(markers)
+    follow_ups_df = pd.read_csv(follow_ups_data_path, usecols=["Laboratory Test", "Test Units"])
+    # The unit of the first row of every marker in the file, as in CohortStore.marker_units
+    first_rows = follow_ups_df.drop_duplicates("Laboratory Test")
+    marker_units = dict(zip(first_rows["Laboratory Test"], first_rows["Test Units"]))
+    return ["" if pd.isna(marker_units.get(marker)) else str(marker_units[marker]) for marker in markers]
+
+
+def extract_samples_cached(clinical_data_path: str, follow_ups_data_path: str, features: List[str],
+                           treatments: List[str], feature2range: Optional[Dict[str, List[float]]] = None,
+                           require_all_features: bool = True, outcome: str = "days_to_next_line",
+                           n_jobs: Optional[int] = 1, cache_dir: Optional[str] = "Data/cache",
+                           per_patient: bool = False, store_path: Optional[str] = None,
+                           chunksize: Optional[int] = None, compact: bool = False
+                           ) -> Tuple[Union[np.ndarray, FeatureMatrix], np.ndarray, np.ndarray]:
+    """ Returns extract_samples over the given files, loaded from the cache when an entry matches.
+    With per_patient, every case is cached on its own and only the cases whose rows changed are recomputed.
+    cache_dir=None always recomputes. Recomputing all cases reads the binary copy at store_path when it is up to date,
+    and otherwise, with chunksize, streams the case-sorted follow-ups file in chunks of that many rows.
+    With compact, X is a FeatureMatrix (see FeatureMatrix.from_samples) with the units of the markers in the cohort.
+    """
+    if compact:
+        X, T, Y = extract_samples_cached(clinical_data_path, follow_ups_data_path, features, treatments,
+                                         feature2range, require_all_features, outcome, n_jobs, cache_dir,
+                                         per_patient, store_path, chunksize)
+        units = get_marker_units(clinical_data_path, follow_ups_data_path, features, store_path)
+        return FeatureMatrix.from_samples(X, features, feature2range, units), T, Y
+    if cache_dir is None:
+        return _extract_all_samples(clinical_data_path, follow_ups_data_path, features, treatments, feature2range,
+                                    require_all_features, outcome, n_jobs, store_path, chunksize)
+    config_hash = get_config_hash(features, treatments, feature2range, require_all_features, outcome)
+    if not per_patient:
+        key = hashlib.sha256(
+            f"{config_hash}{get_file_hash(clinical_data_path)}{get_file_hash(follow_ups_data_path)}".encode()
+        ).hexdigest()
+        path = os.path.join(cache_dir, f"{key}.npz")
+        if os.path.exists(path):
+            return _load_samples(path)
+        samples = _extract_all_samples(clinical_data_path, follow_ups_data_path, features, treatments, feature2range,
+                                       require_all_features, outcome, n_jobs, store_path, chunksize)
+        os.makedirs(cache_dir, exist_ok=True)
+        _save_samples(path, samples)
+        return samples
+
+    clinical_df = pd.read_csv(clinical_data_path)
+    follow_ups_df = pd.read_csv(follow_ups_data_path)
+    cases = get_cases(clinical_df, follow_ups_df)
+    clinical_hashes = get_case_hashes(clinical_df, "case_id")
+    follow_ups_hashes = get_case_hashes(follow_ups_df, "Case ID")
+    paths = {
+        case: os.path.join(cache_dir, "patients", hashlib.sha256(
+            config_hash.encode() + clinical_hashes[case] + follow_ups_hashes[case]).hexdigest() + ".npz")
+        for case in cases
+    }
+    changed = [case for case in cases if not os.path.exists(paths[case])]
+    if changed:
+        changed_store = CohortStore(clinical_df, follow_ups_df, changed)
+        X, T, Y, keys = extract_samples(changed_store, features, treatments, feature2range, require_all_features,
+                                        outcome, n_jobs, return_keys=True)
+        os.makedirs(os.path.join(cache_dir, "patients"), exist_ok=True)
+        for case in changed:
+            in_case = keys[:, 0] == case
+            _save_samples(paths[case], (X[in_case], T[in_case], Y[in_case]))
+    return concatenate_samples([_load_samples(paths[case]) for case in cases])
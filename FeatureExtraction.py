@@ -0,0 +1,227 @@
+"""
+This file is used to extract the X, T, Y arrays of an experiment from a CohortStore in a few sorted array operations.
+A sample is a pair of consecutive lines of therapy of a case:
+X - patient height, weight and the markers of the latest follow-up before the first line
+    (or of the first follow-up in the line when there is none before it)
+T - multi-hot vector of the therapeutic agents of the first line
+Y - the outcome, see OUTCOMES
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from CohortStore import CohortStore, map_store_chunks
+from FollowUpsReader import iter_case_stores
+
+OUTCOMES = [
+    "days_to_next_line",  # days from the start of the line to the start of the next line
+    "next_line_in_range_fraction",  # fraction of the markers in range at the follow-up of the next line
+]
+MISSING = 3  # range code of a marker the follow-up lacks, 0 is in range, 1 below it and 2 above it
+
+
+def discretize_markers(values: np.ndarray, ranges: np.ndarray, has_marker: Optional[np.ndarray] = None
+                       ) -> Tuple[np.ndarray, np.ndarray]:
+    """ Returns the range code (see MISSING) of every marker value of values [n, markers] against the [low, high]
+    ranges [markers, 2], and the fraction of the present markers of every row that are in range, NaN for a row
+    without markers. has_marker marks the present markers, by default the ones that are not NaN.
+    As in the gather loops, a present marker with a NaN value gets the in-range code but is not counted in range.
+    """
+    ranges = np.asarray(ranges, dtype=np.float64)
+    if has_marker is None:
+        has_marker = ~np.isnan(values)
+    codes = ((values < ranges[:, 0]) + 2 * (values > ranges[:, 1])).astype(np.int8)
+    codes[~has_marker] = MISSING
+    in_range = has_marker & (values >= ranges[:, 0]) & (values <= ranges[:, 1])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        in_range_fractions = in_range.sum(1) / has_marker.sum(1)
+    return codes, in_range_fractions
+
+
+def get_lines_of_therapy(store: CohortStore, treatments: List[str]) -> Dict[str, np.ndarray]:
+    """ Returns the lines of therapy of all cases, ordered by case and then as in Patient.get_line_of_therapy_names.
+    Each line has its case, name, first start day, last end day and a multi-hot vector of its agents over treatments.
+    Lines with a missing regimen have NaN start and end days and no agents.
+    """
+    case_pos = np.repeat(np.arange(len(store)), np.diff(store.clinical_offsets))
+    rows = store.clinical_offsets[case_pos] + store.clinical_line_order
+    regimens = store.clinical_columns["regimen_or_line_of_therapy"][rows]
+    starts = store.clinical_columns["days_to_treatment_start"][rows].astype(np.float64)
+    ends = store.clinical_columns["days_to_treatment_end"][rows]
+    agents = store.clinical_columns["therapeutic_agents"][rows]
+
+    regimen_codes, regimen_names = pd.factorize(regimens)
+    line_keys = case_pos * (len(regimen_names) + 1) + regimen_codes + 1
+    _, first_rows, row_line = np.unique(line_keys, return_index=True, return_inverse=True)
+    # np.unique sorts by key, renumber the lines by their first treatment line
+    line_order = np.argsort(first_rows, kind="stable")
+    line_rank = np.empty_like(line_order)
+    line_rank[line_order] = np.arange(len(line_order))
+    row_line = line_rank[row_line.reshape(-1)]
+    n_lines = len(first_rows)
+
+    line_starts = np.full(n_lines, np.inf)
+    line_ends = np.full(n_lines, -np.inf)
+    np.minimum.at(line_starts, row_line, starts)
+    np.maximum.at(line_ends, row_line, ends)
+    line_agents = np.zeros((n_lines, len(treatments)))
+    treatment_index = {treatment: idx for idx, treatment in enumerate(treatments)}
+    agent_idx = np.array([treatment_index.get(agent, -1) for agent in agents], dtype=np.int64)
+    known = agent_idx >= 0
+    line_agents[row_line[known], agent_idx[known]] = 1
+
+    line_codes = regimen_codes[first_rows[line_order]]
+    is_missing = line_codes == -1
+    line_starts[is_missing] = np.nan
+    line_ends[is_missing] = np.nan
+    line_agents[is_missing] = 0
+    return {
+        "case": case_pos[first_rows[line_order]],
+        "name": np.append(np.asarray(regimen_names, dtype=object), None)[line_codes],
+        "start": line_starts,
+        "end": line_ends,
+        "agents": line_agents,
+    }
+
+
+def select_follow_ups(store: CohortStore, cases: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """ Returns the follow-up of each (case, line) as in the gather loops, as a sorted as-of join:
+    the latest follow-up before the line starts, or else the first follow-up in the line, -1 if there is none.
+    """
+    selected = np.full(len(cases), -1, dtype=np.int64)
+    valid = ~np.isnan(starts)
+    if not valid.any() or len(store.follow_up_days) == 0:
+        return selected
+    days = store.follow_up_days
+    follow_up_case = np.repeat(np.arange(len(store)), np.diff(store.follow_up_case_offsets))
+    # (case, day) keys, sorted because the follow-ups are sorted by case and then by day
+    shift = min(days.min(), int(starts[valid].min()))
+    span = max(days.max(), int(starts[valid].max())) - shift + 1
+    follow_up_keys = follow_up_case * span + (days - shift)
+    cases, starts, ends = cases[valid], starts[valid].astype(np.int64), ends[valid]
+
+    first = store.follow_up_case_offsets[cases]
+    last = store.follow_up_case_offsets[cases + 1]
+    first_in_line = np.searchsorted(follow_up_keys, cases * span + (starts - shift), side="left")
+    has_before = first_in_line > first
+    has_in_line = ~has_before & (first_in_line < last)
+    has_in_line[has_in_line] = days[first_in_line[has_in_line]] <= ends[has_in_line]
+    valid_selected = np.full(len(cases), -1, dtype=np.int64)
+    valid_selected[has_before] = first_in_line[has_before] - 1
+    valid_selected[has_in_line] = first_in_line[has_in_line]
+    selected[valid] = valid_selected
+    return selected
+
+
+def extract_samples(store: CohortStore, features: List[str], treatments: List[str],
+                    feature2range: Optional[Dict[str, List[float]]] = None, require_all_features: bool = True,
+                    outcome: str = "days_to_next_line", n_jobs: Optional[int] = 1, return_keys: bool = False
+                    ) -> Tuple[np.ndarray, ...]:
+    """ Returns the X, T, Y arrays of all cases, and with return_keys the (case id, line of therapy) of each sample.
+    With feature2range, markers are replaced by their range code (see MISSING). Without require_all_features,
+    a follow-up may lack markers, which get the MISSING code (NaN without feature2range).
+    With n_jobs other than 1, chunks of cases are extracted in worker processes (None for one per core),
+    and the arrays are the same as the serial ones.
+    """
+    if outcome not in OUTCOMES:
+        raise ValueError(f"Unknown outcome: {outcome}")
+    if n_jobs != 1:
+        samples = map_store_chunks(extract_samples, store, n_jobs, features, treatments, feature2range,
+                                   require_all_features, outcome, 1, return_keys)
+        return concatenate_samples(samples)
+    lines = get_lines_of_therapy(store, treatments)
+    # A sample for every line that has a next line of the same case
+    line_idx = np.flatnonzero(lines["case"][:-1] == lines["case"][1:])
+    next_line_idx = line_idx + 1
+    cases = lines["case"][line_idx]
+    follow_ups = select_follow_ups(store, cases, lines["start"][line_idx], lines["end"][line_idx])
+    keep = follow_ups >= 0
+
+    marker_idx = store.get_marker_indices(features)
+    ranges = np.array([feature2range[feature] for feature in features]) if feature2range is not None else None
+
+    if outcome == "days_to_next_line":
+        Y = lines["start"][next_line_idx] - lines["start"][line_idx]
+    else:
+        next_follow_ups = select_follow_ups(store, cases, lines["start"][next_line_idx], lines["end"][next_line_idx])
+        keep &= next_follow_ups >= 0
+        next_values, next_has_marker = _get_markers(store, next_follow_ups[keep], marker_idx)
+        # As in gather_data_y2.py, a marker counts as in range only when it equals the lower end of its range
+        lower_ends = np.stack((ranges[:, 0], ranges[:, 0]), axis=1)
+        _, in_range_fractions = discretize_markers(next_values, lower_ends, next_has_marker)
+        assert not np.isnan(in_range_fractions).any()
+        Y = np.full(len(keep), np.nan)
+        Y[keep] = in_range_fractions
+
+    keep &= (store.heights[cases] > 0) & (store.weights[cases] > 0)
+    values, has_marker = _get_markers(store, follow_ups[keep], marker_idx)
+    if require_all_features:
+        has_all_markers = has_marker.all(1)
+        keep[keep] = has_all_markers
+        values, has_marker = values[has_all_markers], has_marker[has_all_markers]
+    if not keep.any():
+        return _empty_samples(return_keys)
+
+    if ranges is not None:
+        values, _ = discretize_markers(values, ranges, has_marker)
+    X = np.concatenate((store.heights[cases[keep], None], store.weights[cases[keep], None], values), axis=1)
+    T = lines["agents"][line_idx[keep]]
+    Y = Y[keep]
+    if outcome == "days_to_next_line" and not np.isnan(Y).any():
+        Y = Y.astype(np.int64)
+    if return_keys:
+        keys = np.stack((store.cases[cases[keep]], lines["name"][line_idx[keep]]), axis=1)
+        return X, T, Y, keys
+    return X, T, Y
+
+
+def extract_samples_streamed(clinical_data_path: str, follow_ups_data_path: str, features: List[str],
+                             treatments: List[str], feature2range: Optional[Dict[str, List[float]]] = None,
+                             require_all_features: bool = True, outcome: str = "days_to_next_line",
+                             n_jobs: Optional[int] = 1, return_keys: bool = False, chunksize: int = 100_000
+                             ) -> Tuple[np.ndarray, ...]:
+    """ Returns extract_samples over the given files, reading the follow-ups file in chunks of complete cases
+    (see FollowUpsReader) so that only one chunk is held in memory at a time.
+    The samples are in the order of the follow-ups file, which is the order of extract_samples
+    when both files are sorted by case.
+    """
+    clinical_df = pd.read_csv(clinical_data_path)
+    samples = [
+        extract_samples(store, features, treatments, feature2range, require_all_features, outcome, n_jobs, return_keys)
+        for store in iter_case_stores(clinical_df, follow_ups_data_path, chunksize)
+    ]
+    if not samples:
+        return _empty_samples(return_keys)
+    return concatenate_samples(samples)
+
+
+def concatenate_samples(samples: List[Tuple[np.ndarray, ...]]) -> Tuple[np.ndarray, ...]:
+    """ Returns the X, T, Y (and keys) arrays of consecutive chunks of cases as the arrays of all of them.
+    No chunks give empty X, T, Y arrays.
+    """
+    if not samples:
+        return _empty_samples(False)
+    return_keys = len(samples[0]) == 4
+    samples = [arrays for arrays in samples if len(arrays[0]) > 0]
+    if not samples:
+        return _empty_samples(return_keys)
+    return tuple(np.concatenate(arrays) for arrays in zip(*samples))
+
+
+def _empty_samples(return_keys: bool) -> Tuple[np.ndarray, ...]:
+    if return_keys:
+        return np.array([]), np.array([]), np.array([]), np.empty((0, 2), dtype=object)
+    return np.array([]), np.array([]), np.array([])
+
+
+def _get_markers(store: CohortStore, follow_ups: np.ndarray, marker_idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Returns the values of the markers at the given follow-ups and whether each follow-up has each marker.
+    """
+    known = marker_idx >= 0
+    values = np.full((len(follow_ups), len(marker_idx)), np.nan)
+    has_marker = np.zeros((len(follow_ups), len(marker_idx)), dtype=bool)
+    values[:, known] = store.follow_up_values[follow_ups[:, None], marker_idx[None, known]]
+    has_marker[:, known] = store.follow_up_has_marker[follow_ups[:, None], marker_idx[None, known]]
+    return values, has_marker
@@ -0,0 +1,105 @@
+"""
+This file holds the compact feature matrix that the gather scripts can save X as.
+The range codes of the markers (see FeatureExtraction.MISSING) only take the values 0-3 and are held as int8,
+the other columns (patient height, weight and the raw markers) as float32, next to the schema of the columns.
+The matrix is expanded into a float array in the original column order only when a model is fitted on it.
+# schema of column j:
+names[j] - the feature name
+is_code[j] - whether the column holds range codes
+ranges[j] - the [low, high] range of the codes, NaN for the other columns
+units[j] - the unit of the feature, "" when unknown
+"""
+
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+
+BASE_FEATURES = ["Patient Height", "Patient Weight"]  # the columns extract_samples puts before the markers
+
+
+class FeatureMatrix:
+    def __init__(self, continuous: np.ndarray, codes: np.ndarray, names: List[str], is_code: np.ndarray,
+                 ranges: Optional[np.ndarray] = None, units: Optional[List[str]] = None):
+        self.continuous = np.asarray(continuous, dtype=np.float32)
+        self.codes = np.asarray(codes, dtype=np.int8)
+        self.names = list(names)
+        self.is_code = np.asarray(is_code, dtype=bool)
+        self.ranges = np.full((len(self.names), 2), np.nan) if ranges is None else np.asarray(ranges, dtype=float)
+        self.units = [""] * len(self.names) if units is None else list(units)
+
+    @classmethod
+    def from_array(cls, X: np.ndarray, names: List[str], is_code: np.ndarray, ranges: Optional[np.ndarray] = None,
+                   units: Optional[List[str]] = None) -> "FeatureMatrix":
+        """ Returns the compact matrix of the float matrix X [n, features].
+        """
+        X = np.asarray(X)
+        is_code = np.asarray(is_code, dtype=bool)
+        X = X.reshape(len(X), len(names))
+        codes = X[:, is_code]
+        if codes.size > 0 and (np.isnan(codes).any() or codes.min() < -128 or codes.max() > 127):
+            raise ValueError("code columns must hold integers that fit in int8")
+        return cls(X[:, ~is_code], codes, names, is_code, ranges, units)
+
+    @classmethod
+    def from_samples(cls, X: np.ndarray, features: List[str],
+                     feature2range: Optional[Dict[str, List[float]]] = None,
+                     units: Optional[List[str]] = None) -> "FeatureMatrix":
+        """ Returns the compact matrix of an extract_samples X of the given features.
+        With feature2range, the markers are range codes. units are of the features, without the base features.
+        """
+        names = BASE_FEATURES + list(features)
+        is_code = np.array([False] * len(BASE_FEATURES) + [feature2range is not None] * len(features))
+        ranges = np.full((len(names), 2), np.nan)
+        if feature2range is not None:
+            ranges[len(BASE_FEATURES):] = [feature2range[feature] for feature in features]
+        if units is not None:
+            units = [""] * len(BASE_FEATURES) + list(units)
+        return cls.from_array(X, names, is_code, ranges, units)
+
+    @property
+    def shape(self):
+        return len(self), len(self.names)
+
+    @property
+    def nbytes(self) -> int:
+        return self.continuous.nbytes + self.codes.nbytes
+
+    def __len__(self) -> int:
+        return len(self.continuous)
+
+    def __getitem__(self, rows) -> "FeatureMatrix":
+        """ Returns the matrix of the given rows, with the same schema.
+        """
+        return FeatureMatrix(self.continuous[rows], self.codes[rows], self.names, self.is_code, self.ranges,
+                             self.units)
+
+    def missing_rows(self) -> np.ndarray:
+        """ Returns whether every row has a NaN column, like np.isnan(X).any(1) of the expanded matrix.
+        """
+        return np.isnan(self.continuous).any(1)
+
+    def to_array(self, dtype=np.float64) -> np.ndarray:
+        """ Returns the [n, features] model-ready matrix in the original column order.
+        """
+        X = np.empty(self.shape, dtype=dtype)
+        X[:, ~self.is_code] = self.continuous
+        X[:, self.is_code] = self.codes
+        return X
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return self.to_array(np.float64 if dtype is None else dtype)
+
+    def get_arrays(self) -> Dict[str, np.ndarray]:
+        """ Returns the arrays to save the matrix as, with the schema as a JSON string.
+        """
+        schema = {"names": self.names, "is_code": self.is_code.tolist(), "ranges": self.ranges.tolist(),
+                  "units": self.units}
+        return {"continuous": self.continuous, "codes": self.codes, "schema": np.array(json.dumps(schema))}
+
+    @classmethod
+    def from_arrays(cls, continuous: np.ndarray, codes: np.ndarray, schema: np.ndarray) -> "FeatureMatrix":
+        """ Returns the matrix of the arrays of get_arrays.
+        """
+        schema = json.loads(str(schema))
+        return cls(continuous, codes, schema["names"], schema["is_code"], schema["ranges"], schema["units"])
@@ -1,7 +1,10 @@
-from typing import Tuple
+from typing import List
 
+import numpy as np
 import pandas as pd
 
+from CohortStore import CohortStore
+
 
 class TestData:
     def __init__(self, marker: str, value: float):
@@ -16,26 +19,53 @@ class TestData:
 
 
 class FollowUp:
-    def __init__(self, follow_up_data: pd.DataFrame, follow_up_id: str):
-        self.follow_up_data = follow_up_data
-        self.follow_up_id = follow_up_id
-        self.days_to_follow_up = int(follow_up_data["Days to Follow-Up"][0])
-        self.markers = follow_up_data["Laboratory Test"].unique()
+    def __init__(self, store: CohortStore, follow_up_idx: int):
+        self.store = store
+        self.follow_up_idx = follow_up_idx
+        self.follow_up_id = store.follow_up_ids[follow_up_idx]
+        self.days_to_follow_up = int(store.follow_up_days[follow_up_idx])
+        self._rows = slice(store.follow_up_offsets[follow_up_idx], store.follow_up_offsets[follow_up_idx + 1])
+        first_marker_rows = store.is_first_marker_row[self._rows]
+        self._marker_codes = store.marker_codes[self._rows][first_marker_rows]
+        self._marker_values = store.test_values[self._rows][first_marker_rows]
+        self.markers = store.markers[self._marker_codes]
+
+    @property
+    def follow_up_data(self) -> pd.DataFrame:
+        """ The rows of this follow-up as a DataFrame indexed by "Case ID", built on demand.
+        """
+        case_idx = np.searchsorted(self.store.follow_up_case_offsets, self.follow_up_idx, side="right") - 1
+        n_rows = self._rows.stop - self._rows.start
+        return pd.DataFrame(
+            {
+                "Follow-Up": self.follow_up_id,
+                "Days to Follow-Up": self.days_to_follow_up,
+                "Laboratory Test": self.store.markers[self.store.marker_codes[self._rows]],
+                "Test Value": self.store.test_values[self._rows],
+                "Test Units": self.store.units[self.store.unit_codes[self._rows]],
+                "Patient Height": self.store.heights[case_idx],
+                "Patient Weight": self.store.weights[case_idx],
+            },
+            index=pd.Index([self.store.cases[case_idx]] * n_rows, name="Case ID"),
+        )
 
     def __len__(self) -> int:
         return len(self.markers)
 
     def __getitem__(self, idx) -> TestData:
-        marker = self.markers[idx]
-        marker_value = self.follow_up_data[
-            self.follow_up_data["Laboratory Test"] == marker
-            ]["Test Value"].values[0]
-        return TestData(marker, marker_value)
+        return TestData(self.markers[idx], self._marker_values[idx])
 
     def marker2val(self, marker) -> float:
-        marker_values = self.follow_up_data[
-            self.follow_up_data["Laboratory Test"] == marker
-            ]["Test Value"].values
-        if len(marker_values)==0:
+        marker_idx = self.store.marker_index.get(marker)
+        if marker_idx is None or not self.store.follow_up_has_marker[self.follow_up_idx, marker_idx]:
             return None
-        return marker_values[0]
+        return self.store.follow_up_values[self.follow_up_idx, marker_idx]
+
+    def marker2vals(self, markers: List[str]) -> np.ndarray:
+        """ Returns the values of the given markers as one float array, NaN for the markers this follow-up lacks.
+        """
+        marker_idx = self.store.get_marker_indices(markers)
+        values = np.full(len(marker_idx), np.nan)
+        known = marker_idx >= 0
+        values[known] = self.store.follow_up_values[self.follow_up_idx, marker_idx[known]]
+        return values
@@ -0,0 +1,62 @@
+"""
+This file is used to read the follow_ups_data.csv file in chunks, for follow-ups tables larger than memory.
+The file is sorted by "Case ID" (see DataScraper.reorder_data), so the rows of a case are contiguous and a chunk
+of rows holds complete cases except for its last case, whose rows are carried over to the next chunk.
+At most one chunk of rows and the rows of one case are held in memory at a time.
+"""
+
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+from CohortStore import CohortStore
+from Patient import Patient
+
+
+def read_case_chunks(follow_ups_data_path: str, chunksize: int = 100_000) -> Iterator[pd.DataFrame]:
+    """ Yields the rows of the follow-ups file in DataFrames of about chunksize rows that each hold complete cases.
+    Raises ValueError if the file is not sorted by "Case ID".
+    """
+    carry = None
+    last_case = None
+    for chunk in pd.read_csv(follow_ups_data_path, chunksize=chunksize):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if len(chunk) == 0:  # the chunk of a file without rows
+            continue
+        cases = chunk["Case ID"].to_numpy()
+        if (last_case is not None and cases[0] < last_case) or (cases[1:] < cases[:-1]).any():
+            raise ValueError(f"{follow_ups_data_path} is not sorted by Case ID, see DataScraper.reorder_data")
+        # The last case may continue in the next chunk
+        is_last_case = cases == cases[-1]
+        carry = chunk[is_last_case]
+        if not is_last_case.all():
+            last_case = cases[~is_last_case][-1]
+            yield chunk[~is_last_case]
+    if carry is not None and len(carry) > 0:
+        yield carry
+
+
+def iter_case_stores(clinical_df: pd.DataFrame, follow_ups_data_path: str,
+                     chunksize: int = 100_000) -> Iterator[CohortStore]:
+    """ Yields a CohortStore for every chunk of read_case_chunks, of the chunk's cases that have clinical rows.
+    The stores hold the cases in the order of the follow-ups file.
+    """
+    clinical_cases = clinical_df["case_id"].to_numpy()
+    for chunk in read_case_chunks(follow_ups_data_path, chunksize):
+        chunk_cases = pd.unique(chunk["Case ID"])
+        in_chunk = np.isin(clinical_cases, chunk_cases)
+        if not in_chunk.any():
+            continue
+        cases = chunk_cases[np.isin(chunk_cases, clinical_cases[in_chunk])]
+        yield CohortStore(clinical_df[in_chunk], chunk, list(cases))
+
+
+def iter_patients(clinical_data_path: str, follow_ups_data_path: str, chunksize: int = 100_000) -> Iterator[Patient]:
+    """ Yields the patients of the given files one at a time, reading the follow-ups file in chunks.
+    """
+    clinical_df = pd.read_csv(clinical_data_path)
+    for store in iter_case_stores(clinical_df, follow_ups_data_path, chunksize):
+        for case_idx in range(len(store)):
+            yield Patient(store, case_idx)
@@ -1,25 +1,43 @@
-from typing import List
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, NamedTuple
+
+import numpy as np
 import pandas as pd
 
+from CohortStore import CohortStore
 from FollowUp import FollowUp
 from ClinicalData import ClinicalData
 
 
+class LineOfTherapy(NamedTuple):
+    start: int  # first days_to_treatment_start of the line's treatments
+    end: float  # last days_to_treatment_end of the line's treatments, inf if one of them has not ended
+    agents: np.ndarray  # the line's therapeutic agents, in order of first use
+
+
 class Patient:
-    def __init__(self, clinical_data: pd.DataFrame, follow_ups_data: pd.DataFrame, case_id: str):
-        self.case_id = case_id
-        self.clinical_data = ClinicalData(clinical_data)
-        # There is a "Follow-Up" column in the follow_ups_data dataframe. Each follow-up spreads over multiple rows.
-        self.follow_ups = []
-        self.follow_ups.extend(
-            FollowUp(follow_up_data, follow_up_id)
-            for follow_up_id, follow_up_data in follow_ups_data.groupby(
-                "Follow-Up"
-            )
-        )
-        self.follow_ups.sort(key=lambda follow_up: follow_up.days_to_follow_up)
-        self.height = int(follow_ups_data["Patient Height"].unique())
-        self.weight = int(follow_ups_data["Patient Weight"].unique())
+    def __init__(self, store: CohortStore, case_idx: int):
+        self.store = store
+        self.case_idx = case_idx
+        self.case_id = store.cases[case_idx]
+        self.clinical_data = ClinicalData(store, case_idx)
+        # The follow-ups of a case are stored contiguously, already sorted by days_to_follow_up.
+        self.follow_ups = [
+            FollowUp(store, follow_up_idx)
+            for follow_up_idx in range(store.follow_up_case_offsets[case_idx], store.follow_up_case_offsets[case_idx + 1])
+        ]
+        self.follow_up_days = store.follow_up_days[
+            store.follow_up_case_offsets[case_idx]:store.follow_up_case_offsets[case_idx + 1]].tolist()
+        self.lines_of_therapy = self._get_lines_of_therapy()
+        self.height = int(store.heights[case_idx])
+        self.weight = int(store.weights[case_idx])
+
+    @classmethod
+    def from_data_frames(cls, clinical_data: pd.DataFrame, follow_ups_data: pd.DataFrame, case_id: str) -> "Patient":
+        """ Builds a patient from the clinical_df.loc[case_id] and follow_ups_df.loc[case_id] slices.
+        Prefer Patient(store, case_idx) over a CohortStore of the whole cohort when building many patients.
+        """
+        return cls(CohortStore.from_patient_frames(clinical_data, follow_ups_data, case_id), 0)
 
     def __len__(self) -> int:
         return len(self.follow_ups)
@@ -27,130 +45,98 @@ class Patient:
     def __getitem__(self, idx: int) -> FollowUp:
         return self.follow_ups[idx]
 
-    def get_line_of_therapy_names(self) -> List[str]:
-        return list(self.clinical_data.treatment_lines_data["regimen_or_line_of_therapy"].unique())
-
+    def _get_lines_of_therapy(self) -> Dict[str, LineOfTherapy]:
+        """ Returns the start, end and agents of every line of therapy, in one pass over the sorted treatment lines.
+        Treatment lines with a missing regimen are not part of any line of therapy.
+        """
+        starts, ends, agents = {}, {}, {}
+        for regimen, start, end, agent in zip(self.clinical_data.line_regimens, self.clinical_data.line_starts,
+                                              self.clinical_data.line_ends, self.clinical_data.line_agents):
+            if regimen is None:
+                continue
+            if regimen not in starts:
+                starts[regimen], ends[regimen], agents[regimen] = start, end, [agent]
+                continue
+            starts[regimen] = min(starts[regimen], start)
+            ends[regimen] = max(ends[regimen], end)
+            if agent not in agents[regimen]:
+                agents[regimen].append(agent)
+        return {
+            regimen: LineOfTherapy(starts[regimen], ends[regimen], np.array(agents[regimen], dtype=object))
+            for regimen in starts
+        }
 
+    def get_line_of_therapy_names(self) -> List[str]:
+        return list(pd.unique(self.clinical_data.line_regimens))
 
     def get_follow_ups_in_line_of_therapy(self, line_of_therapy: str) -> List[FollowUp]:
         """ Returns follow-ups that are in the given line of therapy.
         Each line of therapy is a list of treatments that are given in a specific order.
-        A line of therapy can be found in the self.treatment_lines_data.
+        A line of therapy can be found in the self.lines_of_therapy.
         line_of_therapy can be "First line of therapy", "Second line of therapy", etc.
         """
-        first_day_of_line_of_therapy = self.clinical_data.treatment_lines_data[
-            self.clinical_data.treatment_lines_data[
-                "regimen_or_line_of_therapy"
-            ]
-            == line_of_therapy
-            ]["days_to_treatment_start"].min()
-        last_day_of_line_of_therapy = self.clinical_data.treatment_lines_data[
-            self.clinical_data.treatment_lines_data[
-                "regimen_or_line_of_therapy"
-            ]
-            == line_of_therapy
-            ]["days_to_treatment_end"].max()
-
-        return [
-            follow_up
-            for follow_up in self.follow_ups
-            if first_day_of_line_of_therapy <= follow_up.days_to_follow_up
-               <= last_day_of_line_of_therapy
-        ]
+        if line_of_therapy not in self.lines_of_therapy:
+            return []
+        line = self.lines_of_therapy[line_of_therapy]
+        return self.follow_ups[bisect_left(self.follow_up_days, line.start):bisect_right(self.follow_up_days, line.end)]
 
     def get_follow_ups_before_line_of_therapy(self, line_of_therapy: str) -> List[FollowUp]:
         """ Returns follow-ups that are before the given line of therapy.
         Each line of therapy is a list of treatments that are given in a specific order.
-        A line of therapy can be found in the self.treatment_lines_data.
+        A line of therapy can be found in the self.lines_of_therapy.
         line_of_therapy can be "First line of therapy", "Second line of therapy", etc.
         """
-        first_day_of_line_of_therapy = self.clinical_data.treatment_lines_data[
-            self.clinical_data.treatment_lines_data[
-                "regimen_or_line_of_therapy"
-            ]
-            == line_of_therapy
-            ]["days_to_treatment_start"].min()
-
-        return [
-            follow_up
-            for follow_up in self.follow_ups
-            if follow_up.days_to_follow_up < first_day_of_line_of_therapy
-        ]
+        if line_of_therapy not in self.lines_of_therapy:
+            return []
+        line = self.lines_of_therapy[line_of_therapy]
+        return self.follow_ups[:bisect_left(self.follow_up_days, line.start)]
 
     def get_follow_ups_after_line_of_therapy(self, line_of_therapy: str) -> List[FollowUp]:
         """ Returns follow-ups that are after the given line of therapy.
         Each line of therapy is a list of treatments that are given in a specific order.
-        A line of therapy can be found in the self.treatment_lines_data.
+        A line of therapy can be found in the self.lines_of_therapy.
         line_of_therapy can be "First line of therapy", "Second line of therapy", etc.
         """
-        last_day_of_line_of_therapy = self.clinical_data.treatment_lines_data[
-            self.clinical_data.treatment_lines_data[
-                "regimen_or_line_of_therapy"
-            ]
-            == line_of_therapy
-            ]["days_to_treatment_end"].max()
-
-        return [
-            follow_up
-            for follow_up in self.follow_ups
-            if follow_up.days_to_follow_up > last_day_of_line_of_therapy
-        ]
+        if line_of_therapy not in self.lines_of_therapy:
+            return []
+        line = self.lines_of_therapy[line_of_therapy]
+        return self.follow_ups[bisect_right(self.follow_up_days, line.end):]
 
     def get_follow_ups_in_line_of_therapy_and_before(self, line_of_therapy: str) -> List[FollowUp]:
         """ Returns follow-ups that are in the given line of therapy and before it.
         Each line of therapy is a list of treatments that are given in a specific order.
-        A line of therapy can be found in the self.treatment_lines_data.
+        A line of therapy can be found in the self.lines_of_therapy.
         line_of_therapy can be "First line of therapy", "Second line of therapy", etc.
         """
-        last_day_of_line_of_therapy = self.clinical_data.treatment_lines_data[
-            self.clinical_data.treatment_lines_data[
-                "regimen_or_line_of_therapy"
-            ]
-            == line_of_therapy
-            ]["days_to_treatment_end"].max()
-
-        return [
-            follow_up
-            for follow_up in self.follow_ups
-            if follow_up.days_to_follow_up < last_day_of_line_of_therapy
-        ]
+        if line_of_therapy not in self.lines_of_therapy:
+            return []
+        line = self.lines_of_therapy[line_of_therapy]
+        return self.follow_ups[:bisect_left(self.follow_up_days, line.end)]
 
     def get_follow_ups_in_line_of_therapy_and_after(self, line_of_therapy: str) -> List[FollowUp]:
         """ Returns follow-ups that are in the given line of therapy and after it.
         Each line of therapy is a list of treatments that are given in a specific order.
-        A line of therapy can be found in the self.treatment_lines_data.
+        A line of therapy can be found in the self.lines_of_therapy.
         line_of_therapy can be "First line of therapy", "Second line of therapy", etc.
         """
-        first_day_of_line_of_therapy = self.clinical_data.treatment_lines_data[
-            self.clinical_data.treatment_lines_data[
-                "regimen_or_line_of_therapy"
-            ]
-            == line_of_therapy
-            ]["days_to_treatment_start"].min()
-
-        return [
-            follow_up
-            for follow_up in self.follow_ups
-            if follow_up.days_to_follow_up >= first_day_of_line_of_therapy
-        ]
+        if line_of_therapy not in self.lines_of_therapy:
+            return []
+        line = self.lines_of_therapy[line_of_therapy]
+        return self.follow_ups[bisect_left(self.follow_up_days, line.start):]
 
     def get_therapeutic_agents_in_line_of_therapy(self, line_of_therapy: str) -> List[str]:
         """ Returns a list of the therapeutic agents used in the line of surgery.
         """
-        return self.clinical_data.treatment_lines_data[
-            self.clinical_data.treatment_lines_data[
-                "regimen_or_line_of_therapy"
-            ]
-            == line_of_therapy
-            ]["therapeutic_agents"].unique()
+        if line_of_therapy not in self.lines_of_therapy:
+            return np.array([], dtype=object)
+        return self.lines_of_therapy[line_of_therapy].agents
 
     def get_days_from_diagnosis_to_line_of_therapy(self, line_of_therapy: str) -> int:
         """ Returns the number of days from diagnosis to the start of the line of therapy.
         """
-        return self.clinical_data.treatment_lines_data[
-            self.clinical_data.treatment_lines_data["regimen_or_line_of_therapy"]
-            == line_of_therapy
-            ]["days_to_treatment_start"].min()
+        if line_of_therapy not in self.lines_of_therapy:
+            return np.nan
+        return self.lines_of_therapy[line_of_therapy].start
 
     def get_days_between_lines_of_therapy(self, line_of_therapy_1: str, line_of_therapy_2: str) -> int:
         """ Returns the number of days between the end of the first line of therapy and the start of the second line of therapy.
@@ -1,10 +1,171 @@
+import operator
+import os
 import statistics
+import tempfile
 import unittest
 
 import numpy as np
 import pandas as pd
 
+from base_learners import BaseLearner, HistGradientBoostingLearner, LinearLearner, RowSelection, SGDLearner
+from bootstrap import bootstrap_IPW, bootstrap_S_Learner, bootstrap_T_Learner, bootstrap_resampled, draw_weights
+from CohortStore import CohortStore
 from DataLoader import ClinicalDataset
+from DataPreprocess import write_cohort_store
+from FeatureCache import extract_samples_cached, get_marker_units, load_samples, save_samples
+from FeatureExtraction import MISSING, discretize_markers, extract_samples, extract_samples_streamed
+from FeatureMatrix import FeatureMatrix
+from FollowUpsReader import iter_patients
+from sklearn.linear_model import LinearRegression, LogisticRegression, Ridge
+from treatment_sets import TreatmentSets, decode_treatments, encode_treatments, pack_treatments
+
+import models
+from models import AIPW, IPW, BanditState, LinUCB, S_Learner, T_Learner, fit_propensity_model, grouped_least_squares, \
+    run_bandit_algorithm, run_bandit_alpha_sweep
+
+
+SYNTHETIC_TREATMENTS = ["Bortezomib", "Lenalidomide", "Dexamethasone", "Melphalan"]
+SYNTHETIC_MARKERS = ["Albumin", "Calcium", "Creatinine", "Hemoglobin"]
+SYNTHETIC_UNITS = ["g/L", "mmol/L", "umol/L", "g/dL"]
+
+
+def write_synthetic_cohort(directory, n_cases=40, seed=0):
+    """ Writes a small clinical table and follow-ups table to directory, laid out as clinical_sorted.csv and
+    follow_ups_data.csv are, and returns their paths. The cohort has a missing regimen, cases with a single
+    clinical row or without follow-ups, follow-ups with duplicate markers and patients with a height or weight of 0.
+    """
+    rng = np.random.default_rng(seed)
+    regimens = ["First line of therapy", "Second line of therapy", "Third line of therapy", "Fourth line of therapy"]
+    clinical_rows, follow_up_rows = [], []
+    for case in range(n_cases):
+        case_id = f"case-{case:03d}"
+        patient = [case_id, f"MMRF_{case:04d}", 60 + case % 20, "'--", -22000 - case, "'--", "not reported", "female",
+                   "white", "Alive", 22000 + case, 900, 900, "II" if case % 3 else "'--"]
+        n_lines = 1 if case % 9 == 4 else int(rng.integers(2, 5))
+        for line in range(n_lines):
+            start = line * 200 + int(rng.integers(0, 50))
+            end = start + int(rng.integers(30, 150)) if rng.random() > 0.2 else "'--"
+            agents = rng.choice(SYNTHETIC_TREATMENTS + ["Other agent"], 1 if n_lines == 1 else int(rng.integers(1, 3)),
+                                replace=False)
+            for agent in agents:
+                clinical_rows.append(patient + [end, float(start), regimens[line], agent, "yes", "'--"])
+        if case % 10 == 7:
+            clinical_rows.append(patient + ["'--", np.inf, "'--", "'--", "'--", "'--"])
+        if case % 13 == 6:
+            continue  # no follow-ups
+        height = 0 if case % 11 == 2 else int(rng.integers(150, 200))
+        weight = 0 if case % 11 == 5 else int(rng.integers(50, 110))
+        days = np.sort(rng.integers(-60, n_lines * 200 + 100, int(rng.integers(1, 10))))
+        for follow_up, day in enumerate(days):
+            for marker, unit in zip(SYNTHETIC_MARKERS, SYNTHETIC_UNITS):
+                if rng.random() < 0.15:
+                    continue
+                value = round(float(rng.lognormal(1, 0.5)), 1)
+                follow_up_rows.append([case_id, f"{case_id}_{follow_up}", day, marker, value, unit, height, weight])
+                if rng.random() < 0.1:  # a duplicate marker in the same follow-up
+                    follow_up_rows.append([case_id, f"{case_id}_{follow_up}", day, marker, value + 1, unit, height,
+                                           weight])
+    clinical_df = pd.DataFrame(clinical_rows, columns=[
+        "case_id", "case_submitter_id", "age_at_index", "cause_of_death", "days_to_birth", "days_to_death",
+        "ethnicity", "gender", "race", "vital_status", "age_at_diagnosis", "days_to_last_follow_up",
+        "days_to_last_known_disease_status", "iss_stage", "days_to_treatment_end", "days_to_treatment_start",
+        "regimen_or_line_of_therapy", "therapeutic_agents", "treatment_or_therapy", "treatment_type"])
+    follow_ups_df = pd.DataFrame(follow_up_rows, columns=[
+        "Case ID", "Follow-Up", "Days to Follow-Up", "Laboratory Test", "Test Value", "Test Units", "Patient Height",
+        "Patient Weight"])
+    clinical_data_path = os.path.join(directory, "clinical_sorted.csv")
+    follow_ups_data_path = os.path.join(directory, "follow_ups_data.csv")
+    clinical_df.to_csv(clinical_data_path, index=False)
+    follow_ups_df.to_csv(follow_ups_data_path, index=False)
+    return clinical_data_path, follow_ups_data_path
+
+
+def gather_samples(dataset, features, treatments, feature2range=None, require_all_features=True,
+                   outcome="days_to_next_line"):
+    """ The X, T, Y arrays of the loop of the gather scripts, over the patients of dataset.
+    """
+    X, T, Y = [], [], []
+    for patient in dataset:
+        therapy_names = patient.get_line_of_therapy_names()
+        if len(therapy_names) <= 1:
+            continue
+        for therapy_name, next_therapy_name in zip(therapy_names[:-1], therapy_names[1:]):
+            latest_follow_up = _get_latest_follow_up(patient, therapy_name)
+            if latest_follow_up is None:
+                continue
+            t = patient.get_therapeutic_agents_in_line_of_therapy(therapy_name)
+            if outcome == "days_to_next_line":
+                y = patient.get_days_between_lines_of_therapy(therapy_name, next_therapy_name)
+            else:
+                next_latest_follow_up = _get_latest_follow_up(patient, next_therapy_name)
+                if next_latest_follow_up is None:
+                    continue
+                ok, total = 0, 0
+                for feature in features:
+                    val = next_latest_follow_up.marker2val(feature)
+                    if val is None:
+                        continue
+                    if feature2range[feature][0] <= val <= feature2range[feature][0]:
+                        ok += 1
+                    total += 1
+                y = ok / total
+            if patient.height > 0 and patient.weight > 0:
+                if require_all_features and len(set(latest_follow_up.markers).intersection(features)) < len(features):
+                    continue
+                sample = [patient.height, patient.weight]
+                for feature in features:
+                    val = latest_follow_up.marker2val(feature)
+                    if feature2range is not None:
+                        if val is None:
+                            val = 3
+                        elif val < feature2range[feature][0]:
+                            val = 1
+                        elif val > feature2range[feature][1]:
+                            val = 2
+                        else:
+                            val = 0
+                    sample.append(val)
+                X.append(sample)
+                treatment = np.zeros((len(treatments),))
+                for t_ in t:
+                    if t_ in treatments:
+                        treatment[treatments.index(t_)] = 1
+                T.append(treatment)
+                Y.append(y)
+    return np.array(X), np.array(T), np.array(Y)
+
+
+def _get_latest_follow_up(patient, therapy_name):
+    therapy = patient.get_follow_ups_before_line_of_therapy(therapy_name)
+    if len(therapy) == 0:
+        therapy = patient.get_follow_ups_in_line_of_therapy(therapy_name)
+        return therapy[0] if len(therapy) > 0 else None
+    return therapy[-1]
+
+
+def reference_treatment_lines(clinical_df, case_id):
+    """ The treatment_lines_data of the original DataFrame-backed ClinicalData of a case: "'--" and inf starts are
+    day 0, "'--" ends are inf, and the rows are sorted by start and end day.
+    """
+    rows = clinical_df[clinical_df["case_id"] == case_id]
+    starts = pd.to_numeric(rows["days_to_treatment_start"], errors="coerce")
+    ends = pd.to_numeric(rows["days_to_treatment_end"], errors="coerce")
+    regimens = rows["regimen_or_line_of_therapy"]
+    lines = pd.DataFrame({
+        "regimen_or_line_of_therapy": [None if value == "'--" else value for value in regimens],
+        "days_to_treatment_start": starts.where(np.isfinite(starts), 0).to_numpy(),
+        "days_to_treatment_end": ends.fillna(np.inf).to_numpy(),
+        "therapeutic_agents": [None if value == "'--" else value for value in rows["therapeutic_agents"]],
+    })
+    return lines.sort_values(["days_to_treatment_start", "days_to_treatment_end"], kind="stable")
+
+
+def reference_follow_ups(follow_ups_df, case_id):
+    """ The (follow-up id, rows) pairs of the original DataFrame-backed Patient, grouped by follow-up id and sorted
+    by day.
+    """
+    rows = follow_ups_df[follow_ups_df["Case ID"] == case_id]
+    return sorted(rows.groupby("Follow-Up"), key=lambda follow_up: follow_up[1]["Days to Follow-Up"].iloc[0])
 
 
 class MyTestCase(unittest.TestCase):
@@ -26,6 +187,565 @@ class MyTestCase(unittest.TestCase):
         follow_ups = df["Follow-Up"].unique()
         self.assertEqual(len(follow_ups), 8591)
 
+    def test_marker2val_first_match(self):
+        with tempfile.TemporaryDirectory() as directory:
+            clinical_data_path, follow_ups_data_path = write_synthetic_cohort(directory)
+            dataset = ClinicalDataset(clinical_data_path, follow_ups_data_path, store_path=None)
+        markers = list(dataset.markers) + ["Unknown marker"]
+        n_duplicates = 0
+        for index in range(len(dataset)):
+            for follow_up in dataset[index]:
+                follow_up_data = follow_up.follow_up_data
+                n_duplicates += follow_up_data["Laboratory Test"].duplicated().sum()
+                values = follow_up.marker2vals(markers)
+                for marker, value in zip(markers, values):
+                    expected = follow_up_data[follow_up_data["Laboratory Test"] == marker]["Test Value"].values
+                    if len(expected) == 0:
+                        self.assertIsNone(follow_up.marker2val(marker))
+                        self.assertTrue(np.isnan(value))
+                    else:
+                        np.testing.assert_equal(follow_up.marker2val(marker), expected[0])
+                        np.testing.assert_equal(value, expected[0])
+        self.assertGreater(n_duplicates, 0)
+
+    def test_cohort_store_binary_copy(self):
+        with tempfile.TemporaryDirectory() as directory:
+            clinical_data_path, follow_ups_data_path = write_synthetic_cohort(directory)
+            store_path = os.path.join(directory, "cohort_store")
+            write_cohort_store(clinical_data_path, follow_ups_data_path, store_path)
+            self.assertTrue(CohortStore.is_saved_from(store_path, [clinical_data_path, follow_ups_data_path]))
+            loaded = ClinicalDataset(clinical_data_path, follow_ups_data_path, store_path=store_path)
+            parsed = ClinicalDataset(clinical_data_path, follow_ups_data_path, store_path=None)
+            self.assertEqual(loaded.cases, parsed.cases)
+            self.assertEqual(loaded.marker_units_dict, parsed.marker_units_dict)
+            for index in range(len(parsed)):
+                loaded_patient, parsed_patient = loaded[index], parsed[index]
+                for attribute in ["iss_stage", "therapeutic_agents", "regimen_or_line_of_therapy",
+                                  "days_to_treatment_start", "days_to_treatment_end", "age_at_index"]:
+                    self.assertEqual(getattr(loaded_patient.clinical_data, attribute),
+                                     getattr(parsed_patient.clinical_data, attribute))
+                self.assertEqual(loaded_patient.follow_up_days, parsed_patient.follow_up_days)
+                for loaded_follow_up, parsed_follow_up in zip(loaded_patient, parsed_patient):
+                    self.assertEqual(loaded_follow_up.follow_up_id, parsed_follow_up.follow_up_id)
+                    np.testing.assert_equal(loaded_follow_up.marker2vals(list(parsed.markers)),
+                                            parsed_follow_up.marker2vals(list(parsed.markers)))
+
+            # The follow-up ids are those of the file in file order on both paths, with the follow-ups of cases
+            # without clinical rows, which the store leaves out
+            follow_ups_df = pd.read_csv(follow_ups_data_path).iloc[::-1]
+            follow_ups_df.iloc[0, follow_ups_df.columns.get_loc("Case ID")] = "case-without-clinical-rows"
+            follow_ups_df.iloc[0, follow_ups_df.columns.get_loc("Follow-Up")] = "follow-up-without-clinical-rows"
+            follow_ups_df.to_csv(follow_ups_data_path, index=False)
+            write_cohort_store(clinical_data_path, follow_ups_data_path, store_path)
+            loaded = ClinicalDataset(clinical_data_path, follow_ups_data_path, store_path=store_path)
+            parsed = ClinicalDataset(clinical_data_path, follow_ups_data_path, store_path=None)
+            np.testing.assert_equal(loaded.follow_ups, follow_ups_df["Follow-Up"].unique())
+            np.testing.assert_equal(parsed.follow_ups, follow_ups_df["Follow-Up"].unique())
+            self.assertIsNone(loaded._follow_ups_df)
+
+    def test_patient_views_match_data_frames(self):
+        # Follow-ups on the first and last day of a line, on the same day, without a marker or with a duplicate one,
+        # a line that has not ended and a missing regimen
+        clinical_columns = ["case_id", "case_submitter_id", "age_at_index", "cause_of_death", "days_to_birth",
+                            "days_to_death", "ethnicity", "gender", "race", "vital_status", "age_at_diagnosis",
+                            "days_to_last_follow_up", "days_to_last_known_disease_status", "iss_stage",
+                            "days_to_treatment_end", "days_to_treatment_start", "regimen_or_line_of_therapy",
+                            "therapeutic_agents", "treatment_or_therapy", "treatment_type"]
+        patient = ["'--", "'--", "'--", "'--", "'--", "'--", "'--", "'--", "'--", "'--", "'--", "'--"]
+        clinical_df = pd.DataFrame([
+            ["case-a", "MMRF_0001"] + patient + [100, 0.0, "First line of therapy", "Bortezomib", "yes", "'--"],
+            ["case-a", "MMRF_0001"] + patient + [90, 10.0, "First line of therapy", "Dexamethasone", "yes", "'--"],
+            ["case-a", "MMRF_0001"] + patient + ["'--", 150.0, "Second line of therapy", "Lenalidomide", "yes", "'--"],
+            ["case-a", "MMRF_0001"] + patient + ["'--", np.inf, "'--", "'--", "'--", "'--"],
+            ["case-b", "MMRF_0002"] + patient + [60, 30.0, "First line of therapy", "Melphalan", "yes", "'--"],
+        ], columns=clinical_columns)
+        follow_up_rows = [("case-a", "a_0", -20, "Albumin", 40.0), ("case-a", "a_0", -20, "Calcium", 2.4),
+                          ("case-a", "a_1", 0, "Albumin", 41.0),
+                          ("case-a", "a_2", 100, "Albumin", 42.0), ("case-a", "a_2", 100, "Albumin", 43.0),
+                          ("case-a", "a_2", 100, "Calcium", 2.5),
+                          ("case-a", "a_4", 150, "Calcium", 2.6), ("case-a", "a_3", 150, "Albumin", 44.0),
+                          ("case-a", "a_5", 400, "Albumin", 45.0),
+                          ("case-b", "b_0", 30, "Albumin", 46.0), ("case-b", "b_1", 60, "Calcium", 2.7),
+                          ("case-b", "b_2", 61, "Albumin", 47.0)]
+        follow_ups_df = pd.DataFrame([row + ("g/L", 170, 70) for row in follow_up_rows], columns=[
+            "Case ID", "Follow-Up", "Days to Follow-Up", "Laboratory Test", "Test Value", "Test Units",
+            "Patient Height", "Patient Weight"])
+        with tempfile.TemporaryDirectory() as directory:
+            clinical_data_path = os.path.join(directory, "clinical_sorted.csv")
+            follow_ups_data_path = os.path.join(directory, "follow_ups_data.csv")
+            clinical_df.to_csv(clinical_data_path, index=False)
+            follow_ups_df.to_csv(follow_ups_data_path, index=False)
+            dataset = ClinicalDataset(clinical_data_path, follow_ups_data_path, store_path=None)
+            clinical_df = pd.read_csv(clinical_data_path)
+            follow_ups_df = pd.read_csv(follow_ups_data_path)
+        self.assertEqual(dataset.cases, ["case-a", "case-b"])
+        queries = {
+            "get_follow_ups_in_line_of_therapy": lambda day, first, last: first <= day <= last,
+            "get_follow_ups_before_line_of_therapy": lambda day, first, last: day < first,
+            "get_follow_ups_after_line_of_therapy": lambda day, first, last: day > last,
+            "get_follow_ups_in_line_of_therapy_and_before": lambda day, first, last: day < last,
+            "get_follow_ups_in_line_of_therapy_and_after": lambda day, first, last: day >= first,
+        }
+        for patient in dataset:
+            lines = reference_treatment_lines(clinical_df, patient.case_id)
+            follow_ups = reference_follow_ups(follow_ups_df, patient.case_id)
+            days = [rows["Days to Follow-Up"].iloc[0] for _, rows in follow_ups]
+            self.assertEqual([follow_up.follow_up_id for follow_up in patient], [name for name, _ in follow_ups])
+            self.assertEqual(patient.get_line_of_therapy_names(), list(lines["regimen_or_line_of_therapy"].unique()))
+            self.assertEqual(sorted(patient.clinical_data.days_to_treatment_end),
+                             sorted(lines["days_to_treatment_end"]))
+            for name in patient.get_line_of_therapy_names() + ["Fifth line of therapy"]:
+                line = lines[lines["regimen_or_line_of_therapy"] == name]
+                first, last = line["days_to_treatment_start"].min(), line["days_to_treatment_end"].max()
+                for query, in_query in queries.items():
+                    self.assertEqual([follow_up.follow_up_id for follow_up in getattr(patient, query)(name)],
+                                     [follow_up_id for (follow_up_id, _), day in zip(follow_ups, days)
+                                      if in_query(day, first, last)], (patient.case_id, name, query))
+                self.assertEqual(list(patient.get_therapeutic_agents_in_line_of_therapy(name)),
+                                 list(line["therapeutic_agents"].unique()))
+                np.testing.assert_equal(patient.get_days_from_diagnosis_to_line_of_therapy(name), first)
+                # The latest follow-up before the line, or else the first one in it
+                before = [follow_up_id for (follow_up_id, _), day in zip(follow_ups, days) if day < first]
+                in_line = [follow_up_id for (follow_up_id, _), day in zip(follow_ups, days) if first <= day <= last]
+                latest_follow_up = _get_latest_follow_up(patient, name)
+                self.assertEqual(None if latest_follow_up is None else latest_follow_up.follow_up_id,
+                                 before[-1] if before else in_line[0] if in_line else None)
+            for follow_up, (_, rows) in zip(patient, follow_ups):
+                for marker in ["Albumin", "Calcium", "Glucose"]:
+                    values = rows[rows["Laboratory Test"] == marker]["Test Value"].to_numpy()
+                    self.assertEqual(follow_up.marker2val(marker), values[0] if len(values) > 0 else None)
+        patient = dataset[0]
+        self.assertEqual(patient.get_days_between_lines_of_therapy("First line of therapy", "Second line of therapy"),
+                         150)
+        self.assertEqual([follow_up.follow_up_id for follow_up in
+                          patient.get_follow_ups_in_line_of_therapy("First line of therapy")], ["a_1", "a_2"])
+        self.assertEqual(_get_latest_follow_up(patient, "Second line of therapy").follow_up_id, "a_2")
+
+    def test_patient_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            clinical_data_path, follow_ups_data_path = write_synthetic_cohort(directory)
+            dataset = ClinicalDataset(clinical_data_path, follow_ups_data_path, cache_size=3, store_path=None)
+        first = dataset[0]
+        self.assertIs(dataset[0], first)
+        for index in [1, 2, 0, 3]:
+            dataset[index]
+        # 1 is the least recently used patient when 3 is built
+        self.assertEqual(list(dataset._patients), [2, 0, 3])
+        self.assertIs(dataset[0], first)
+        self.assertIs(dataset[-1], dataset[len(dataset) - 1])
+        self.assertEqual(len(dataset._patients), 3)
+        # Prefetched patients are served from the cache
+        dataset.prefetch([5, 6])
+        prefetched = dict(dataset._patients)
+        self.assertEqual(list(prefetched)[-2:], [5, 6])
+        self.assertIs(dataset[5], prefetched[5])
+        self.assertIs(dataset[6], prefetched[6])
+        dataset.cache_size = 0
+        dataset._patients.clear()
+        self.assertIsNot(dataset[0], dataset[0])
+        self.assertEqual(len(dataset._patients), 0)
+        function = operator.methodcaller("get_line_of_therapy_names")
+        expected = [function(patient) for patient in dataset]
+        for n_jobs in [1, 2]:
+            self.assertEqual(dataset.map_patients(function, n_jobs=n_jobs), expected)
+
+    def test_streamed_patients(self):
+        with tempfile.TemporaryDirectory() as directory:
+            clinical_data_path, follow_ups_data_path = write_synthetic_cohort(directory)
+            dataset = ClinicalDataset(clinical_data_path, follow_ups_data_path, store_path=None)
+            case_index = {case: index for index, case in enumerate(dataset.cases)}
+            streamed_cases = []
+            for patient in iter_patients(clinical_data_path, follow_ups_data_path, chunksize=50):
+                streamed_cases.append(patient.case_id)
+                expected = dataset[case_index[patient.case_id]]
+                self.assertEqual(patient.follow_up_days, expected.follow_up_days)
+                self.assertEqual(patient.get_line_of_therapy_names(), expected.get_line_of_therapy_names())
+            self.assertEqual(sorted(streamed_cases), sorted(dataset.cases))
+
+            # A follow-ups file with only its header has no samples, like in memory
+            follow_ups_df = pd.read_csv(follow_ups_data_path).iloc[:0]
+            follow_ups_df.to_csv(follow_ups_data_path, index=False)
+            expected = extract_samples(CohortStore(pd.read_csv(clinical_data_path), follow_ups_df), SYNTHETIC_MARKERS,
+                                       SYNTHETIC_TREATMENTS, return_keys=True)
+            streamed = extract_samples_streamed(clinical_data_path, follow_ups_data_path, SYNTHETIC_MARKERS,
+                                                SYNTHETIC_TREATMENTS, return_keys=True, chunksize=50)
+            self.assertEqual(len(streamed), len(expected))
+            for array, expected_array in zip(streamed, expected):
+                self.assertEqual(array.shape, expected_array.shape)
+                self.assertEqual(array.dtype, expected_array.dtype)
+
+    def test_extract_samples(self):
+        with tempfile.TemporaryDirectory() as directory:
+            clinical_data_path, follow_ups_data_path = write_synthetic_cohort(directory)
+            dataset = ClinicalDataset(clinical_data_path, follow_ups_data_path, store_path=None)
+        store = dataset.store
+        # The cohort has a missing regimen, single-row cases and a height and weight of 0
+        self.assertTrue(any(dataset[index].get_line_of_therapy_names().count(None) for index in range(len(dataset))))
+        self.assertTrue((np.diff(store.clinical_offsets) == 1).any())
+        self.assertTrue((store.heights == 0).any() and (store.weights == 0).any())
+        feature2range = {marker: [2.5, 4] for marker in SYNTHETIC_MARKERS}
+        for kwargs in [{}, {"feature2range": feature2range},
+                       {"feature2range": feature2range, "require_all_features": False},
+                       {"feature2range": feature2range, "require_all_features": False,
+                        "outcome": "next_line_in_range_fraction"}]:
+            expected = gather_samples(dataset, SYNTHETIC_MARKERS, SYNTHETIC_TREATMENTS, **kwargs)
+            samples = extract_samples(store, SYNTHETIC_MARKERS, SYNTHETIC_TREATMENTS, **kwargs)
+            self.assertGreater(len(expected[0]), 0)
+            for array, expected_array in zip(samples, expected):
+                self.assertEqual(array.dtype, expected_array.dtype)
+                np.testing.assert_equal(array, expected_array)
+            if "outcome" in kwargs:
+                self.assertTrue((expected[2] > 0).any())
+
+    def test_extract_samples_in_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            clinical_data_path, follow_ups_data_path = write_synthetic_cohort(directory)
+            dataset = ClinicalDataset(clinical_data_path, follow_ups_data_path, store_path=None)
+        feature2range = {marker: [2.5, 4] for marker in SYNTHETIC_MARKERS}
+        serial = extract_samples(dataset.store, SYNTHETIC_MARKERS, SYNTHETIC_TREATMENTS, feature2range,
+                                 require_all_features=False, n_jobs=1, return_keys=True)
+        parallel = extract_samples(dataset.store, SYNTHETIC_MARKERS, SYNTHETIC_TREATMENTS, feature2range,
+                                   require_all_features=False, n_jobs=2, return_keys=True)
+        for array, serial_array in zip(parallel, serial):
+            self.assertEqual(array.dtype, serial_array.dtype)
+            self.assertEqual(array.shape, serial_array.shape)
+            if array.dtype == object:
+                self.assertEqual(array.tolist(), serial_array.tolist())
+            else:
+                self.assertEqual(array.tobytes(), serial_array.tobytes())
+        self.assertEqual(dataset.map_patients(operator.attrgetter("case_id"), n_jobs=2), dataset.cases)
+
+    def test_feature_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            clinical_data_path, follow_ups_data_path = write_synthetic_cohort(directory)
+            cache_dir = os.path.join(directory, "cache")
+            arguments = [clinical_data_path, follow_ups_data_path, SYNTHETIC_MARKERS, SYNTHETIC_TREATMENTS]
+            expected = extract_samples_cached(*arguments, cache_dir=None)
+            for array, expected_array in zip(extract_samples_cached(*arguments, cache_dir=cache_dir), expected):
+                np.testing.assert_equal(array, expected_array)
+            # A hit loads the entry instead of recomputing it
+            entry, = [name for name in os.listdir(cache_dir) if name.endswith(".npz")]
+            X, T, Y = expected
+            save_samples(os.path.join(cache_dir, entry), X, T, Y + 1)
+            np.testing.assert_equal(extract_samples_cached(*arguments, cache_dir=cache_dir)[2], Y + 1)
+            # Another configuration is another entry
+            samples = extract_samples_cached(*arguments[:2], SYNTHETIC_MARKERS[:2], SYNTHETIC_TREATMENTS,
+                                             cache_dir=cache_dir)
+            np.testing.assert_equal(samples[0], extract_samples_cached(*arguments[:2], SYNTHETIC_MARKERS[:2],
+                                                                       SYNTHETIC_TREATMENTS, cache_dir=None)[0])
+            self.assertEqual(len([name for name in os.listdir(cache_dir) if name.endswith(".npz")]), 2)
+            # With compact, X is a FeatureMatrix with the units of the markers, from the file or the binary copy
+            compact_X = extract_samples_cached(*arguments, cache_dir=cache_dir, compact=True)[0]
+            np.testing.assert_allclose(compact_X.to_array(), X, rtol=1e-6)
+            self.assertEqual(compact_X.units, ["", ""] + SYNTHETIC_UNITS)
+            store_path = os.path.join(directory, "cohort_store")
+            write_cohort_store(clinical_data_path, follow_ups_data_path, store_path)
+            for path in [None, store_path]:
+                self.assertEqual(get_marker_units(clinical_data_path, follow_ups_data_path,
+                                                  ["Calcium", "Glucose", "Albumin"], path), ["mmol/L", "", "g/L"])
+
+            # Per patient, only the cases whose rows changed are recomputed
+            extract_samples_cached(*arguments, cache_dir=cache_dir, per_patient=True)
+            patients_dir = os.path.join(cache_dir, "patients")
+            n_entries = len(os.listdir(patients_dir))
+            follow_ups_df = pd.read_csv(follow_ups_data_path)
+            follow_ups_df.loc[follow_ups_df["Case ID"] == follow_ups_df["Case ID"].iloc[0], "Test Value"] += 1
+            follow_ups_df.to_csv(follow_ups_data_path, index=False)
+            samples = extract_samples_cached(*arguments, cache_dir=cache_dir, per_patient=True)
+            self.assertEqual(len(os.listdir(patients_dir)), n_entries + 1)
+            for array, expected_array in zip(samples, extract_samples_cached(*arguments, cache_dir=None)):
+                np.testing.assert_equal(array, expected_array)
+
+            # An empty follow-ups file has no samples
+            follow_ups_df.iloc[:0].to_csv(follow_ups_data_path, index=False)
+            for per_patient in [False, True]:
+                X, T, Y = extract_samples_cached(*arguments, cache_dir=cache_dir, per_patient=per_patient)
+                self.assertEqual((len(X), len(T), len(Y)), (0, 0, 0))
+
+    def test_linucb_incremental_inverse(self):
+        rng = np.random.default_rng(0)
+        n_samples, n_features, n_treatments = 300, 6, 4
+        X = np.concatenate((rng.normal(170, 10, (n_samples, 1)), rng.normal(0, 5, (n_samples, n_features - 1))), axis=1)
+        T = rng.integers(0, n_treatments, n_samples)
+        Y = rng.normal(size=n_samples)
+        bandit = LinUCB(n_features, n_treatments, alpha=0.1)
+        for features, reward, treatment in zip(X, Y, T):
+            bandit.update(features, reward, treatment)
+        for i in range(n_treatments):
+            np.testing.assert_allclose(bandit.A_inv[i] @ bandit.A[i], np.identity(n_features), atol=1e-8)
+            np.testing.assert_allclose(bandit.theta[i], np.linalg.solve(bandit.A[i], bandit.b[i]), rtol=1e-6)
+        expected = np.array([[np.linalg.inv(bandit.A[i]).dot(bandit.b[i]).dot(features) + bandit.alpha * np.sqrt(
+            features.dot(np.linalg.inv(bandit.A[i])).dot(features)) for i in range(n_treatments)] for features in X])
+        for features, expected_rewards in zip(X[:20], expected):
+            np.testing.assert_allclose(bandit.rewards(features), expected_rewards, rtol=1e-6)
+        np.testing.assert_allclose(bandit.rewards_batch(X), expected, rtol=1e-6)
+
+    def test_linucb_fit(self):
+        rng = np.random.default_rng(1)
+        n_samples, n_features, n_treatments = 500, 5, 6
+        X = rng.normal(size=(n_samples, n_features))
+        T = rng.integers(0, n_treatments, n_samples)
+        Y = rng.normal(size=n_samples)
+        sequential = LinUCB(n_features, n_treatments, alpha=0.1)
+        for features, reward, treatment in zip(X, Y, T):
+            sequential.update(features, reward, treatment)
+        bulk = LinUCB(n_features, n_treatments, alpha=0.1).fit(X, T, Y)
+        chunked = LinUCB(n_features, n_treatments, alpha=0.1)
+        for start in range(0, n_samples, 128):
+            chunked.partial_fit(X[start:start + 128], T[start:start + 128], Y[start:start + 128])
+        for bandit in [bulk, chunked]:
+            np.testing.assert_allclose(bandit.A, sequential.A, atol=1e-9)
+            np.testing.assert_allclose(bandit.b, sequential.b, atol=1e-9)
+            np.testing.assert_allclose(bandit.rewards_batch(X), sequential.rewards_batch(X), rtol=1e-8)
+
+    def test_bandit_alpha_sweep(self):
+        rng = np.random.default_rng(2)
+        X = rng.normal(size=(200, 5))
+        T = rng.integers(0, 12, 200)
+        Y = rng.normal(size=200)
+        alphas = np.linspace(0, 1, 6)
+        sweep_rewards, sweep_actions = run_bandit_alpha_sweep(X, T, Y, 12, alphas)
+        for alpha, rewards, actions in zip(alphas, sweep_rewards, sweep_actions):
+            expected_rewards, expected_actions = run_bandit_algorithm(X, T, Y, 12, alpha)
+            np.testing.assert_allclose(rewards, expected_rewards, rtol=1e-10)
+            np.testing.assert_equal(np.sort(actions, 1), np.sort(expected_actions, 1))
+
+    def test_bandit_state_ingest(self):
+        rng = np.random.default_rng(3)
+        X = rng.normal(size=(120, 4))
+        T = rng.integers(0, 2, (120, 3))
+        Y = rng.normal(size=120)
+        keys = np.array([[f"case{i // 2}", f"line{i % 2}"] for i in range(120)])
+        state = BanditState(["a", "b", "c", "d"], ["x", "y", "z"], alpha=0.1)
+        self.assertEqual(state.ingest(X[:80], T[:80], Y[:80], keys[:80]), 80)
+        with tempfile.TemporaryDirectory() as bandit_path:
+            state.save(bandit_path)
+            state = BanditState.load(bandit_path)
+        # The first 80 samples were already ingested
+        self.assertEqual(state.ingest(X, T, Y, keys), 40)
+        treatments_sets = np.unique(T, axis=0)
+        arms = (T[:, None, :] == treatments_sets[None, :, :]).all(2).argmax(1)
+        expected = LinUCB(4, len(treatments_sets), alpha=0.1).fit(X, arms, Y)
+        order = [np.flatnonzero((treatments_sets == treatments_set).all(1))[0] for treatments_set in state.treatments_sets]
+        np.testing.assert_allclose(state.bandit.A, expected.A[order])
+        np.testing.assert_allclose(state.bandit.rewards_batch(X), expected.rewards_batch(X)[:, order], rtol=1e-6)
+        # A^-1 is recomputed from A after every batch, not only updated
+        np.testing.assert_equal(state.bandit.A_inv, np.linalg.inv(state.bandit.A))
+
+    def test_learners_counterfactual_outcomes(self):
+        rng = np.random.default_rng(4)
+        n_treatments = 12
+        X = rng.normal(size=(400, 5))
+        T = rng.integers(0, n_treatments, 400)
+        Y = X.dot(rng.normal(size=5)) + T + rng.normal(size=400)
+        model = LinearRegression().fit(np.concatenate((X, T[:, None]), axis=1), Y)
+        expected_s = np.stack([model.predict(np.concatenate((X, np.full((X.shape[0], 1), fill_value=i)), axis=1))
+                               for i in range(n_treatments)], axis=1)
+        expected_t = np.stack([LinearRegression().fit(X[T == i], Y[T == i]).predict(X) for i in range(n_treatments)],
+                              axis=1)
+        for learner, expected in [(S_Learner, expected_s), (T_Learner, expected_t)]:
+            rewards, actions = learner(X, T, Y, n_treatments)
+            np.testing.assert_allclose(rewards, expected.mean(0), rtol=1e-10)
+            np.testing.assert_equal(np.sort(actions, 1), np.sort(expected.argpartition(-10, axis=1)[:, -10:], 1))
+
+    def test_grouped_least_squares(self):
+        rng = np.random.default_rng(5)
+        X = rng.normal(170, 10, size=(300, 6))
+        # Treatments 0 and 1 have fewer samples than features
+        T = np.concatenate(([0, 1, 1], rng.integers(2, 8, 297)))
+        Y = rng.normal(size=300)
+        for ridge, model in [(0.0, LinearRegression()), (2.0, Ridge(alpha=2.0))]:
+            coefs, intercepts = grouped_least_squares(X, T, Y, 8, ridge)
+            for i in range(8):
+                fitted = model.fit(X[T == i], Y[T == i])
+                np.testing.assert_allclose(X.dot(coefs[i]) + intercepts[i], fitted.predict(X), rtol=1e-6, atol=1e-8)
+
+    def test_bootstrap_replicates(self):
+        rng = np.random.default_rng(6)
+        n_treatments = 12
+        X = rng.normal(size=(300, 4))
+        T = rng.integers(0, n_treatments, 300)
+        Y = X.dot(rng.normal(size=4)) + T + rng.normal(size=300)
+        weights = np.concatenate((np.ones((1, 300)), draw_weights(300, 3, seed=0)))
+        s_replicates = bootstrap_S_Learner(X, T, Y, n_treatments, weights)
+        t_replicates = bootstrap_T_Learner(X, T, Y, n_treatments, weights)
+        resampled = bootstrap_resampled(T_Learner, X, T, Y, n_treatments, weights, 1)
+        np.testing.assert_allclose(bootstrap_IPW(X, T, Y, n_treatments, weights[:1])[0], IPW(X, T, Y, n_treatments))
+        for replicate_weights, s_rewards, t_rewards, resampled_rewards in zip(weights, s_replicates, t_replicates,
+                                                                              resampled):
+            samples = np.repeat(np.arange(300), replicate_weights.astype(int))
+            np.testing.assert_allclose(s_rewards, S_Learner(X[samples], T[samples], Y[samples], n_treatments)[0],
+                                       rtol=1e-8)
+            np.testing.assert_allclose(t_rewards, T_Learner(X[samples], T[samples], Y[samples], n_treatments)[0],
+                                       rtol=1e-8)
+            np.testing.assert_allclose(t_rewards, resampled_rewards, rtol=1e-8)
+
+    def test_propensity_model_cache(self):
+        rng = np.random.default_rng(7)
+        X = rng.normal(size=(1000, 6))
+        T = (X[:, 0] > 0).astype(int) + (X[:, 1] > 0.5) * 2
+        with tempfile.TemporaryDirectory() as cache_dir:
+            model = fit_propensity_model(X, T, 500, cache_dir)
+            self.assertIs(fit_propensity_model(X, T, 500, cache_dir), model)
+            models._propensity_models.clear()
+            loaded = fit_propensity_model(X, T, 500, cache_dir)
+            np.testing.assert_allclose(loaded.predict_proba(X), model.predict_proba(X))
+            changed_X = X.copy()
+            changed_X[:10] = rng.normal(size=(10, 6))
+            # Without a warm-start key a fit does not depend on the models fitted before it
+            cold = fit_propensity_model(changed_X, T, 500, cache_dir)
+            self.assertFalse(cold.warm_start)
+            np.testing.assert_equal(cold.coef_, LogisticRegression(max_iter=500).fit(changed_X, T).coef_)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            # With a key it starts from the latest model of the key, also in another process
+            fit_propensity_model(X, T, 500, cache_dir, warm_start_key="experiment")
+            models._propensity_models.clear()
+            models._warm_start_models.clear()
+            changed_X[10:20] = rng.normal(size=(10, 6))
+            self.assertTrue(fit_propensity_model(changed_X, T, 500, cache_dir, warm_start_key="experiment").warm_start)
+            self.assertFalse(fit_propensity_model(changed_X[::-1], T[::-1], 500, cache_dir, "other").warm_start)
+        for i in range(models.MAX_PROPENSITY_MODELS + 4):
+            fit_propensity_model(X[i:], T[i:], 50)
+        self.assertEqual(len(models._propensity_models), models.MAX_PROPENSITY_MODELS)
+        models._propensity_models.clear()
+        models._warm_start_models.clear()
+
+    def test_aipw_cross_fitting(self):
+        rng = np.random.default_rng(8)
+        n_treatments = 6
+        X = rng.normal(size=(2000, 4))
+        T = rng.integers(0, n_treatments, 2000)
+        effects = rng.normal(size=n_treatments)
+        Y = X.dot(rng.normal(size=4)) + effects[T] + rng.normal(size=2000) * 0.1
+        rewards = AIPW(X, T, Y, n_treatments, n_jobs=1)
+        np.testing.assert_allclose(AIPW(X, T, Y, n_treatments, n_jobs=2), rewards)
+        np.testing.assert_allclose(rewards - rewards.mean(), effects - effects.mean(), atol=0.05)
+
+    def test_aipw_small_treatments(self):
+        # unscaled, confounded features with a treatment of 12 samples and one of a single sample
+        rng = np.random.default_rng(10)
+        counts = [400, 300, 200, 12, 1]
+        T = np.repeat(np.arange(len(counts)), counts)
+        X = np.column_stack([rng.normal(170, 10, len(T)) + T * 3, rng.normal(70, 15, len(T)),
+                             rng.lognormal(3, 1, size=(len(T), 4))])
+        Y = 300 + (X[:, 0] - 170) * 2 + rng.normal(size=len(T)) * 20
+        rewards = AIPW(X, T, Y, len(counts), n_jobs=1)
+        # the single sample is missing from the training samples of its own fold
+        self.assertTrue(np.isnan(rewards[-1]))
+        np.testing.assert_allclose(rewards[:-1], 300, atol=60)
+
+    def test_base_learners(self):
+        rng = np.random.default_rng(9)
+        n_treatments = 12
+        X = rng.normal(size=(3000, 4))
+        T = rng.integers(0, n_treatments, 3000)
+        Y = X.dot(rng.normal(size=4)) + T * 0.5 + rng.normal(size=3000) * 0.1
+        with tempfile.TemporaryDirectory() as directory:
+            np.save(os.path.join(directory, "X.npy"), X)
+            X_mapped = np.load(os.path.join(directory, "X.npy"), mmap_mode="r")
+            rows = np.flatnonzero(T == 3)
+            selection = RowSelection(X_mapped, rows)
+            self.assertEqual(selection.shape, (len(rows), 4))
+            np.testing.assert_equal(selection[10:20], X[rows[10:20]])
+            np.testing.assert_equal(np.asarray(selection), X[rows])
+            for learner in [S_Learner, T_Learner]:
+                rewards, actions = learner(X, T, Y, n_treatments)
+                linear_rewards, linear_actions = learner(X_mapped, T, Y, n_treatments, base_learner=LinearLearner())
+                np.testing.assert_allclose(linear_rewards, rewards, rtol=1e-8)
+                np.testing.assert_equal(np.sort(linear_actions, 1), np.sort(actions, 1))
+                sgd_rewards, sgd_actions = learner(X_mapped, T, Y, n_treatments,
+                                                   base_learner=SGDLearner(chunk_size=500))
+                np.testing.assert_allclose(sgd_rewards, rewards, atol=0.05)
+                boosting_rewards, boosting_actions = learner(X_mapped, T, Y, n_treatments,
+                                                             base_learner=HistGradientBoostingLearner(n_threads=1))
+                self.assertEqual(np.shape(boosting_rewards), (n_treatments,))
+                self.assertEqual(boosting_actions.shape, (3000, 10))
+        with self.assertRaises(TypeError):
+            BaseLearner()
+
+    def test_treatment_sets(self):
+        rng = np.random.default_rng(10)
+        agents = [f"agent {j}" for j in range(17)]
+        T = (rng.random((500, 17)) < 0.15).astype(int)
+        np.testing.assert_equal(decode_treatments(encode_treatments(T), 17), T)
+        treatments_sets = TreatmentSets(agents)
+        indices = treatments_sets.fit_transform(T)
+        unique_sets = np.unique(T, axis=0)
+        np.testing.assert_equal(treatments_sets.sets, unique_sets)
+        np.testing.assert_equal(unique_sets[indices], T)
+        np.testing.assert_equal(treatments_sets.transform(T[::-1]), indices[::-1])
+        np.testing.assert_equal(treatments_sets.inverse_transform(indices), T)
+        self.assertEqual(treatments_sets.names([indices[0]]), [[agents[j] for j in T[0].nonzero()[0]]])
+        with self.assertRaises(ValueError):
+            TreatmentSets(agents, treatments_sets.codes[:1]).transform(T)
+
+    def test_packed_treatments(self):
+        rng = np.random.default_rng(11)
+        X = rng.normal(size=(300, 4))
+        T = (rng.random((300, 17)) < 0.15).astype(float)
+        Y = rng.integers(0, 1000, 300)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "samples.npz")
+            save_samples(path, X, T, Y)
+            loaded_X, loaded_T, loaded_Y = load_samples(path)
+            np.testing.assert_equal(loaded_T, T)
+            self.assertEqual(loaded_T.dtype, T.dtype)
+            np.testing.assert_equal(loaded_X, X)
+            np.testing.assert_equal(loaded_Y, Y)
+            _, packed_T, _ = load_samples(path, packed=True)
+            self.assertEqual(packed_T.shape, (300, 3))
+            # npz files with a dense T load the same
+            np.savez(path, X=X, T=T, Y=Y)
+            np.testing.assert_equal(load_samples(path, packed=True)[1], packed_T)
+        treatments_sets = TreatmentSets(range(17))
+        np.testing.assert_equal(treatments_sets.fit_transform(packed_T, packed=True), TreatmentSets(range(17)).fit_transform(T))
+        np.testing.assert_equal(pack_treatments(T), packed_T)
+
+    def test_compact_feature_matrix(self):
+        rng = np.random.default_rng(12)
+        features = ["Albumin", "Calcium", "Creatinine"]
+        feature2range = {"Albumin": [33, 57], "Calcium": [2.25, 2.62], "Creatinine": [53, 114.9]}
+        X = np.concatenate((rng.normal(170, 10, (200, 1)).round(1), rng.normal(80, 10, (200, 1)).round(1),
+                            rng.integers(0, 4, (200, 3))), axis=1)
+        X[5, 0] = np.nan
+        compact_X = FeatureMatrix.from_samples(X, features, feature2range, units=["g/L", "mmol/L", "umol/L"])
+        self.assertEqual(compact_X.codes.dtype, np.int8)
+        self.assertEqual(compact_X.continuous.dtype, np.float32)
+        self.assertLess(compact_X.nbytes, X.nbytes / 3)
+        np.testing.assert_allclose(compact_X.to_array(), X, rtol=1e-6)
+        np.testing.assert_equal(compact_X.to_array()[:, 2:], X[:, 2:])
+        np.testing.assert_equal(compact_X.missing_rows(), np.isnan(X).any(1))
+        np.testing.assert_equal(compact_X[10:20].to_array(), compact_X.to_array()[10:20])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "samples.npz")
+            save_samples(path, compact_X, np.zeros((200, 17)), np.arange(200))
+            loaded_X = load_samples(path)[0]
+            self.assertEqual(loaded_X.names, ["Patient Height", "Patient Weight"] + features)
+            self.assertEqual(loaded_X.units[2:], ["g/L", "mmol/L", "umol/L"])
+            np.testing.assert_equal(loaded_X.ranges[2:], [feature2range[feature] for feature in features])
+            np.testing.assert_equal(load_samples(path, compact=False)[0], compact_X.to_array())
+
+    def test_discretize_markers(self):
+        rng = np.random.default_rng(13)
+        ranges = np.array([[33, 57], [2.25, 2.62], [0, 3]])
+        values = rng.normal(ranges.mean(1), ranges[:, 1] - ranges[:, 0], (100, 3))
+        values[:, 1] = np.where(rng.random(100) < 0.5, ranges[1, 0], values[:, 1])
+        values[rng.random((100, 3)) < 0.2] = np.nan
+        codes, in_range_fractions = discretize_markers(values, ranges)
+        for row, row_codes, fraction in zip(values, codes, in_range_fractions):
+            ok, total = 0, 0
+            for val, (low, high), code in zip(row, ranges, row_codes):
+                if np.isnan(val):
+                    self.assertEqual(code, MISSING)
+                    continue
+                self.assertEqual(code, 1 if val < low else 2 if val > high else 0)
+                ok += low <= val <= high
+                total += 1
+            if total == 0:
+                self.assertTrue(np.isnan(fraction))
+            else:
+                self.assertAlmostEqual(fraction, ok / total)
+
     @unittest.skip("Skip test_manually")
     def test_manually(self):
         clinical_data_path = "clinical_sorted.tsv"
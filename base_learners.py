@@ -0,0 +1,132 @@
+from abc import ABCMeta, abstractmethod
+
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.linear_model import LinearRegression, SGDRegressor
+from sklearn.preprocessing import StandardScaler
+from threadpoolctl import threadpool_limits
+
+# Base learners are the outcome models of S_Learner and T_Learner. They are sklearn regressors (so sklearn.clone works)
+# with a fit(X, Y) / predict(X) interface where X may be an np.memmap, a ColumnStack or a RowSelection, read chunk_size
+# rows at a time
+# by the learners that fit out of core. n_threads limits the OpenMP/BLAS threads of a learner (None for no limit).
+
+class ColumnStack:
+    # X with column appended as its last feature, without copying X: slices are concatenated chunk by chunk,
+    # and np.asarray builds the whole matrix for the learners that need it in memory
+    def __init__(self, X, column):
+        self.X = X
+        self.column = column
+        self.shape = (X.shape[0], X.shape[1] + 1)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        return np.concatenate((self.X[rows], self.column[rows, None]), axis=1)
+
+    def __array__(self, dtype=None, copy=None):
+        stacked = self[:]
+        return stacked if dtype is None else stacked.astype(dtype)
+
+class RowSelection:
+    # the given rows of X (sorted row indices), without copying X: slices read only their rows of X chunk by chunk,
+    # and np.asarray builds the selected matrix for the learners that need it in memory
+    def __init__(self, X, rows):
+        self.X = X
+        self.rows = rows
+        self.shape = (len(rows), X.shape[1])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        return self.X[self.rows[rows]]
+
+    def __array__(self, dtype=None, copy=None):
+        selected = self[:]
+        return selected if dtype is None else selected.astype(dtype)
+
+def iter_chunks(n_samples, chunk_size):
+    for start in range(0, n_samples, chunk_size):
+        yield slice(start, min(start + chunk_size, n_samples))
+
+class BaseLearner(BaseEstimator, RegressorMixin, metaclass=ABCMeta):
+    chunk_size = 10000
+    n_threads = None
+
+    @abstractmethod
+    def fit(self, X, Y):
+        pass
+
+    def predict(self, X):
+        with threadpool_limits(limits=self.n_threads):
+            return np.concatenate([self._predict(np.asarray(X[rows], dtype=float)) for rows in iter_chunks(len(X), self.chunk_size)])
+
+    def _predict(self, X):
+        return self.model_.predict(X)
+
+class LinearLearner(BaseLearner):
+    # sklearn LinearRegression, which the learners use by default
+    def __init__(self, chunk_size=10000, n_threads=None):
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads
+
+    def fit(self, X, Y):
+        with threadpool_limits(limits=self.n_threads):
+            self.model_ = LinearRegression().fit(np.asarray(X, dtype=float), Y)
+        return self
+
+class HistGradientBoostingLearner(BaseLearner):
+    # sklearn HistGradientBoostingRegressor, fitted in memory on binned features with n_threads OpenMP threads
+    def __init__(self, max_iter=100, learning_rate=0.1, max_leaf_nodes=31, min_samples_leaf=20, chunk_size=10000,
+                 n_threads=None, random_state=0):
+        self.max_iter = max_iter
+        self.learning_rate = learning_rate
+        self.max_leaf_nodes = max_leaf_nodes
+        self.min_samples_leaf = min_samples_leaf
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads
+        self.random_state = random_state
+
+    def fit(self, X, Y):
+        self.model_ = HistGradientBoostingRegressor(max_iter=self.max_iter, learning_rate=self.learning_rate,
+                                                    max_leaf_nodes=self.max_leaf_nodes,
+                                                    min_samples_leaf=self.min_samples_leaf,
+                                                    random_state=self.random_state)
+        with threadpool_limits(limits=self.n_threads):
+            self.model_.fit(np.asarray(X, dtype=float), Y)
+        return self
+
+class SGDLearner(BaseLearner):
+    # linear model fitted by SGD with partial_fit over chunks of chunk_size rows, so X is never loaded as a whole:
+    # one pass over the chunks fits the feature scaling, then n_epochs passes over the chunks in random order
+    def __init__(self, n_epochs=5, alpha=1e-4, eta0=0.01, chunk_size=10000, n_threads=None, random_state=0):
+        self.n_epochs = n_epochs
+        self.alpha = alpha
+        self.eta0 = eta0
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads
+        self.random_state = random_state
+
+    def fit(self, X, Y):
+        rng = np.random.default_rng(self.random_state)
+        chunks = list(iter_chunks(len(X), self.chunk_size))
+        Y = np.asarray(Y, dtype=float)
+        # the targets are standardized too, so eta0 does not depend on the scale of the outcome
+        self.y_mean_ = Y.mean()
+        self.y_scale_ = Y.std() if Y.std() > 0 else 1.0
+        self.scaler_ = StandardScaler()
+        self.model_ = SGDRegressor(alpha=self.alpha, eta0=self.eta0, random_state=self.random_state)
+        with threadpool_limits(limits=self.n_threads):
+            for rows in chunks:
+                self.scaler_.partial_fit(np.asarray(X[rows], dtype=float))
+            for epoch in range(self.n_epochs):
+                for i in rng.permutation(len(chunks)):
+                    X_chunk = self.scaler_.transform(np.asarray(X[chunks[i]], dtype=float))
+                    self.model_.partial_fit(X_chunk, (Y[chunks[i]] - self.y_mean_) / self.y_scale_)
+        return self
+
+    def _predict(self, X):
+        return self.model_.predict(self.scaler_.transform(X)) * self.y_scale_ + self.y_mean_
\ No newline at end of file
@@ -0,0 +1,110 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import os
+from sklearn.linear_model import LogisticRegression
+from models import fit_propensity_model
+
+# A bootstrap replicate is a row of multinomial weights: how many times every sample is drawn into the replicate.
+# The linear learners and IPW are weighted sums over the samples, so all replicates are computed together as
+# matrix products of the [replicates, n] weights; the other estimators are run on the resampled data in processes.
+
+def draw_weights(n_samples, n_replicates, seed=None):
+    # [replicates, n] number of times every sample is drawn, each row sums to n_samples
+    rng = np.random.default_rng(seed)
+    return rng.multinomial(n_samples, np.full(n_samples, 1 / n_samples), size=n_replicates).astype(float)
+
+def confidence_intervals(replicates, level=0.95):
+    # percentile interval of every treatment over the [replicates, treatments] estimates, ignoring NaN replicates
+    low = np.nanpercentile(replicates, 100 * (1 - level) / 2, axis=0)
+    high = np.nanpercentile(replicates, 100 * (1 + level) / 2, axis=0)
+    return low, high
+
+def _weighted_least_squares(X, Y, weights):
+    # weighted LinearRegression of Y on X for every row of weights, like sklearn on the resampled data:
+    # returns the weighted means of X and Y and the coefficients, [replicates, features], [replicates], [replicates, features]
+    # the minimum-norm solution is taken for rank-deficient replicates, eigenvalues below 1e-10 of the largest
+    # possible one (the trace of the second moment) are dropped
+    n_samples, n_features = X.shape
+    X = X - X.mean(0)
+    counts = weights.sum(1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_means = weights.dot(X) / counts[:, None]
+        y_means = weights.dot(Y) / counts
+    second_moment = weights.dot((X[:, :, None] * X[:, None, :]).reshape(n_samples, -1)).reshape(-1, n_features, n_features)
+    gram = second_moment - counts[:, None, None] * x_means[:, :, None] * x_means[:, None, :]
+    xy = weights.dot(X * Y[:, None]) - counts[:, None] * x_means * y_means[:, None]
+
+    has_samples = counts > 0
+    coefs = np.full((len(weights), n_features), np.nan)
+    eigenvalues, eigenvectors = np.linalg.eigh(gram[has_samples])
+    scale = np.trace(second_moment[has_samples], axis1=1, axis2=2)
+    keep = eigenvalues > 1e-10 * scale[:, None]
+    inverse_eigenvalues = np.where(keep, 1 / np.where(keep, eigenvalues, 1), 0)
+    projected = np.einsum('kji,kj->ki', eigenvectors, xy[has_samples]) * inverse_eigenvalues
+    coefs[has_samples] = np.einsum('kij,kj->ki', eigenvectors, projected)
+    return x_means, y_means, coefs
+
+def bootstrap_S_Learner(X, T, Y, n_treatments, weights):
+    # [replicates, treatments] S_Learner rewards of every replicate
+    x_means, y_means, coefs = _weighted_least_squares(np.concatenate((X, T[:,None]), axis=1), Y, weights)
+    # the mean prediction with the treatment index set to i only differs from the mean of Y in the treatment term
+    t_means = x_means[:, -1] + T.mean()
+    return y_means[:, None] + coefs[:, -1:] * (np.arange(n_treatments)[None, :] - t_means[:, None])
+
+def bootstrap_T_Learner(X, T, Y, n_treatments, weights):
+    # [replicates, treatments] T_Learner rewards of every replicate, NaN where a replicate draws no sample of a treatment
+    X = X - X.mean(0)
+    all_means = weights.dot(X) / weights.sum(1)[:, None]
+    rewards = np.full((len(weights), n_treatments), np.nan)
+    for i in range(n_treatments):
+        Ti = T==i
+        x_means, y_means, coefs = _weighted_least_squares(X[Ti], Y[Ti], weights[:, Ti])
+        # x_means are relative to the mean of the treatment's samples
+        x_means = x_means + X[Ti].mean(0)
+        rewards[:, i] = y_means + ((all_means - x_means) * coefs).sum(1)
+    return rewards
+
+def bootstrap_IPW(X, T, Y, n_treatments, weights, max_iter=500, refit=False, n_jobs=1, cache_dir=None):
+    # [replicates, treatments] IPW rewards of every replicate
+    # the propensity model is fitted once on all samples (and shared with IPW through the cache of
+    # models.fit_propensity_model), so the intervals are conditional on it and leave out the variance of the
+    # propensity estimate; with refit it is fitted again on every replicate in processes
+    if refit:
+        return bootstrap_resampled(_IPW_resampled, X, T, Y, n_treatments, weights, n_jobs, max_iter)
+    model = fit_propensity_model(X, T, max_iter, cache_dir)
+    probs = model.predict_proba(X)
+    ipw_weights = 1/probs[np.arange(X.shape[0]),T]
+    one_hot = (T[:,None] == np.arange(n_treatments)[None, :]).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return weights.dot(one_hot * (Y*ipw_weights)[:,None]) / weights.dot(one_hot * ipw_weights[:,None])
+
+def _IPW_resampled(X, T, Y, n_treatments, max_iter):
+    # IPW on resampled data, where treatments may be missing from the propensity model's classes
+    model = LogisticRegression(max_iter=max_iter).fit(X, T)
+    probs = model.predict_proba(X)
+    weights = 1/probs[np.arange(X.shape[0]), np.searchsorted(model.classes_, T)]
+    weighted_Y = Y*weights
+    return [(weighted_Y[T==i].sum())/(weights[T==i].sum()) if (T==i).any() else np.nan for i in range(n_treatments)]
+
+def _run_resampled(estimator, X, T, Y, n_treatments, weights, args):
+    rewards = []
+    for replicate_weights in weights:
+        samples = np.repeat(np.arange(X.shape[0]), replicate_weights.astype(int))
+        result = estimator(X[samples], T[samples], Y[samples], n_treatments, *args)
+        # estimators that also return actions return (rewards, actions)
+        rewards.append(np.asarray(result[0] if isinstance(result, tuple) else result, dtype=float))
+    return np.array(rewards)
+
+def bootstrap_resampled(estimator, X, T, Y, n_treatments, weights, n_jobs=1, *args):
+    # [replicates, treatments] rewards of estimator(X, T, Y, n_treatments, *args) on the resampled data of every
+    # replicate, serially or in n_jobs worker processes (None for one per core)
+    # estimator must be picklable, i.e. defined at the top level of a module, and with worker processes a calling
+    # script must run under an if __name__ == "__main__" guard, as the spawn start method re-imports it in every worker
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+    chunks = np.array_split(weights, min(n_jobs, len(weights)))
+    if len(chunks) == 1:
+        return _run_resampled(estimator, X, T, Y, n_treatments, weights, args)
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        results = executor.map(_run_resampled, *zip(*[(estimator, X, T, Y, n_treatments, chunk, args) for chunk in chunks]))
+        return np.concatenate(list(results))
\ No newline at end of file
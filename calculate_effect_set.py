@@ -1,7 +1,11 @@
 import numpy as np
 import pandas as pd
 import os
-from models import S_Learner, T_Learner, IPW, run_bandit_algorithm
+from models import S_Learner, T_Learner, IPW, AIPW, run_bandit_algorithm, run_bandit_alpha_sweep
+from FeatureCache import load_samples
+from FeatureMatrix import FeatureMatrix
+from treatment_sets import TreatmentSets
+from bootstrap import draw_weights, confidence_intervals, bootstrap_S_Learner, bootstrap_T_Learner, bootstrap_IPW, bootstrap_resampled
 
 ############################################################
 exp_name = "exp1_Y2"
@@ -9,64 +13,85 @@ exp_name = "exp1_Y2"
 treatments = ['Bortezomib', 'Ixazomib', 'Panobinostat', 'Carmustine', 'Carfilzomib', 'Lenalidomide', 'Dexamethasone', 'Melphalan', 'Cyclophosphamide', 'Bendamustine', 'Prednisone', 'Thalidomide', 'Pomalidomide', 'Elotuzumab', 'Other', 'Daratumumab', 'Doxorubicin']
 
 alpha = 0.1
+alphas = []  # more alphas to sweep from the same fit, each adds a Bandits column, e.g. np.linspace(0, 1, 20)
+
+n_bootstrap = 0  # bootstrap replicates for the confidence interval columns, e.g. 200, 0 to skip them
+ipw_refit = True  # refit the propensity model of IPW on every replicate, False keeps the model of all samples and gives narrower intervals conditional on it
+ci_level = 0.95
+n_jobs = None  # worker processes for the bootstrap refits and the AIPW folds, None for one per core and 1 to run serially
+n_folds = 5  # cross-fitting folds of AIPW
+base_learner = None  # outcome model of the S and T learners instead of linear regression, from base_learners.py, e.g. HistGradientBoostingLearner(n_threads=4) or SGDLearner() to fit out of core
+propensity_cache_dir = "Data/cache/propensity"  # None to fit the propensity model of IPW again on every run
+propensity_warm_start = False  # start a new propensity fit from the last one of this experiment, faster after small data changes but the result then depends on the previous run
 ############################################################
 
-npzfile = np.load(f"Data/{exp_name}.npz")
-X = npzfile["X"]
-T = npzfile["T"].astype(int)
-Y = npzfile["Y"]
+if __name__ == "__main__":
+    # X stays a compact FeatureMatrix (when it was saved as one) until the models are fitted
+    X, T, Y = load_samples(f"Data/{exp_name}.npz", packed=True)
+
+    bad_lines = X.missing_rows() if isinstance(X, FeatureMatrix) else np.isnan(X).any(1)
+    X = X[~bad_lines]
+    T = T[~bad_lines]
+    Y = Y[~bad_lines]
 
-bad_lines = (np.isnan(X).nonzero()[0])
-X = np.delete(X, bad_lines, 0)
-T = np.delete(T, bad_lines, 0)
-Y = np.delete(Y, bad_lines, 0)
+    print("number of samples:", X.shape[0])
 
-print("number of samples:", X.shape[0])
+    treatments_sets = TreatmentSets(treatments)
+    T = treatments_sets.fit_transform(T, packed=True)
+    n_treatments = len(treatments_sets)
+    sets_names = treatments_sets.names()
 
-treatments_sets = np.unique(T, axis=0)
-n_treatments = treatments_sets.shape[0]
-sets_names = []
-for treatments_set in treatments_sets:
-    name = []
-    for ind in treatments_set.nonzero()[0]:
-        name.append(treatments[ind])
-    sets_names.append(name)
+    X = np.asarray(X, dtype=float)
 
-new_T = []
-for t in T:
-    matches = treatments_sets==t[None,...]
-    T_ind = matches.all(1).nonzero()[0]
-    assert T_ind.shape[0]==1
-    new_T.append(T_ind)
-T = np.array(new_T).squeeze(1)
+    rewards_bandits, actions_bandits = run_bandit_algorithm(X, T, Y, n_treatments, alpha)
+    if len(alphas) > 0:
+        rewards_bandits_sweep, actions_bandits_sweep = run_bandit_alpha_sweep(X, T, Y, n_treatments, alphas)
+    rewards_S_learner, actions_S_learner = S_Learner(X, T, Y, n_treatments, base_learner)
+    rewards_T_learner, actions_T_learner = T_Learner(X, T, Y, n_treatments, base_learner=base_learner)
+    rewards_IPW = IPW(X, T, Y, n_treatments, 10000, propensity_cache_dir, exp_name if propensity_warm_start else None)
+    rewards_AIPW = AIPW(X, T, Y, n_treatments, n_folds, 10000, n_jobs=n_jobs)
 
-rewards_bandits, actions_bandits = run_bandit_algorithm(X, T, Y, n_treatments, alpha)
-rewards_S_learner, actions_S_learner = S_Learner(X, T, Y, n_treatments)
-rewards_T_learner, actions_T_learner = T_Learner(X, T, Y, n_treatments)
-rewards_IPW = IPW(X, T, Y, n_treatments, 10000)
+    replicates = {}
+    if n_bootstrap > 0:
+        bootstrap_weights = draw_weights(X.shape[0], n_bootstrap, seed=0)
+        replicates['Bandits'] = bootstrap_resampled(run_bandit_algorithm, X, T, Y, n_treatments, bootstrap_weights, n_jobs, alpha)
+        if base_learner is None:  # the batched bootstrap is of the linear learners
+            replicates['S_Learner'] = bootstrap_S_Learner(X, T, Y, n_treatments, bootstrap_weights)
+            replicates['T_Learner'] = bootstrap_T_Learner(X, T, Y, n_treatments, bootstrap_weights)
+        ipw_name = 'IPW' if ipw_refit else 'IPW fixed propensity'
+        replicates[ipw_name] = bootstrap_IPW(X, T, Y, n_treatments, bootstrap_weights, 10000, ipw_refit, n_jobs,
+                                             propensity_cache_dir)
 
-print((actions_bandits==T[:,None]).any(axis=1).mean(), (actions_S_learner==T[:,None]).any(axis=1).mean(), (actions_T_learner==T[:,None]).any(axis=1).mean())
+    print((actions_bandits==T[:,None]).any(axis=1).mean(), (actions_S_learner==T[:,None]).any(axis=1).mean(), (actions_T_learner==T[:,None]).any(axis=1).mean())
 
-df = pd.DataFrame(columns=['Set', 'Count', 'Frequency', 'Bandits', 'S_Learner', 'T_Learner', 'IPW'])
-for i in range(n_treatments):
-    Ti = (T==i)
-    df.loc[i] = [sets_names[i], 
-        Ti.sum(), 
-        Ti.mean(), 
-        rewards_bandits[i], 
-        rewards_S_learner[i], 
-        rewards_T_learner[i], 
-        rewards_IPW[i]]
-os.makedirs("Results", exist_ok=True)
-df.to_excel(f"Results/{exp_name}.xlsx")  
+    df = pd.DataFrame(columns=['Set', 'Count', 'Frequency', 'Bandits', 'S_Learner', 'T_Learner', 'IPW', 'AIPW'])
+    for i in range(n_treatments):
+        Ti = (T==i)
+        df.loc[i] = [sets_names[i], 
+            Ti.sum(), 
+            Ti.mean(), 
+            rewards_bandits[i], 
+            rewards_S_learner[i], 
+            rewards_T_learner[i], 
+            rewards_IPW[i],
+            rewards_AIPW[i]]
+    for j, sweep_alpha in enumerate(alphas):
+        print(f"alpha={sweep_alpha:g}:", (actions_bandits_sweep[j]==T[:,None]).any(axis=1).mean())
+        df[f'Bandits alpha={sweep_alpha:g}'] = rewards_bandits_sweep[j]
+    for name, estimates in replicates.items():
+        low, high = confidence_intervals(estimates, ci_level)
+        df[f'{name} CI low'] = low
+        df[f'{name} CI high'] = high
+    os.makedirs("Results", exist_ok=True)
+    df.to_excel(f"Results/{exp_name}.xlsx")  
 
-'''print("#"*50)
-print(f"alpha={alpha}:\n")
-for i in range(n_treatments):
-    print("Treatment {} | bandits: {:.2f} S_Learner: {:.2f} T_Learner: {:.2f} IPW: {:.2f}".format(
-        sets_names[i], 
-        rewards_bandits[i], 
-        rewards_S_learner[i], 
-        rewards_T_learner[i], 
-        rewards_IPW[i]))
-print("")'''
\ No newline at end of file
+    '''print("#"*50)
+    print(f"alpha={alpha}:\n")
+    for i in range(n_treatments):
+        print("Treatment {} | bandits: {:.2f} S_Learner: {:.2f} T_Learner: {:.2f} IPW: {:.2f}".format(
+            sets_names[i], 
+            rewards_bandits[i], 
+            rewards_S_learner[i], 
+            rewards_T_learner[i], 
+            rewards_IPW[i]))
+    print("")'''
\ No newline at end of file
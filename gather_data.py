@@ -1,11 +1,15 @@
-import pandas as pd
-from Patient import Patient
-import numpy as np
+from FeatureCache import extract_samples_cached, save_samples
 import os
 
 ############################################################
 clinical_data_path = "clinical_sorted.csv"
 follow_ups_data_path = "follow_ups_data.csv"
+n_jobs = None  # worker processes for the extraction, None for one per core and 1 to run serially
+cache_dir = "Data/cache"  # None to always recompute
+per_patient_cache = False  # cache every case on its own, to only recompute the cases that changed
+store_path = "cohort_store"  # binary copy written by DataPreprocess.py, read instead of the CSV files when up to date
+chunksize = None  # rows per chunk to stream the follow-ups file in, for files larger than memory
+compact = False  # save X as a FeatureMatrix, of int8 range codes and float32 values
 
 exp_name = "exp1"
 
@@ -14,59 +18,10 @@ features = ['Albumin', 'Calcium', 'Total Protein', 'Creatinine', 'Immunoglobulin
 treatments = ['Bortezomib', 'Ixazomib', 'Panobinostat', 'Carmustine', 'Carfilzomib', 'Lenalidomide', 'Dexamethasone', 'Melphalan', 'Cyclophosphamide', 'Bendamustine', 'Prednisone', 'Thalidomide', 'Pomalidomide', 'Elotuzumab', 'Other', 'Daratumumab', 'Doxorubicin']
 ############################################################
 
-clinical_df = pd.read_csv(clinical_data_path)
-follow_ups_df = pd.read_csv(follow_ups_data_path)
+if __name__ == "__main__":
+    X, T, Y = extract_samples_cached(clinical_data_path, follow_ups_data_path, features, treatments,
+                                     n_jobs=n_jobs, cache_dir=cache_dir, per_patient=per_patient_cache,
+                                     store_path=store_path, chunksize=chunksize, compact=compact)
 
-cases = clinical_df["case_id"].unique()
-follow_ups = follow_ups_df["Follow-Up"].unique()
-markers = follow_ups_df["Laboratory Test"].unique()
-
-cases = [case for case in cases if case in follow_ups_df["Case ID"].unique()]
-clinical_df.set_index("case_id", inplace=True)
-follow_ups_df.set_index("Case ID", inplace=True)
-
-X, T, Y = [], [], []
-
-for ind in range(len(cases)):
-    case_id = cases[ind]
-    clinical_data = clinical_df.loc[case_id]
-    follow_ups_data = follow_ups_df.loc[case_id]
-
-    patient = Patient(clinical_data, follow_ups_data, case_id)
-    therapy_names = patient.get_line_of_therapy_names()
-    if len(therapy_names)<=1:
-        continue
-    for therapy_name, next_therapy_name in zip(therapy_names[:-1], therapy_names[1:]):
-        therapy = patient.get_follow_ups_before_line_of_therapy(therapy_name)
-        if len(therapy)==0:
-            therapy = patient.get_follow_ups_in_line_of_therapy(therapy_name)
-            if len(therapy)==0:
-                continue
-            latest_follow_up = therapy[0]
-        else:
-            latest_follow_up = therapy[-1]
-        t = patient.get_therapeutic_agents_in_line_of_therapy(therapy_name)
-        y = patient.get_days_between_lines_of_therapy(therapy_name, next_therapy_name)
-        
-        if patient.height>0 and patient.weight>0:
-            markers = set(latest_follow_up.markers)
-            if len(markers.intersection(features)) == len(features):
-                sample = [patient.height, patient.weight]
-                for feature in features:
-                    val = latest_follow_up.marker2val(feature)
-                    assert isinstance(val, float)
-                    sample.append(val)
-                X.append(sample)
-                treatment = np.zeros((len(treatments),))
-                for t_ in t:
-                    if t_ in treatments:
-                        treatment[treatments.index(t_)] = 1
-                T.append(treatment)
-                Y.append(y)
-
-X = np.array(X)
-T = np.array(T)
-Y = np.array(Y)
-
-os.makedirs("Data", exist_ok=True)
-np.savez(f"Data/{exp_name}", X=X, T=T, Y=Y)
\ No newline at end of file
+    os.makedirs("Data", exist_ok=True)
+    save_samples(f"Data/{exp_name}", X, T, Y)
\ No newline at end of file
@@ -1,11 +1,15 @@
-import pandas as pd
-from Patient import Patient
-import numpy as np
+from FeatureCache import extract_samples_cached, save_samples
 import os
 
 ############################################################
 clinical_data_path = "clinical_sorted.csv"
 follow_ups_data_path = "follow_ups_data.csv"
+n_jobs = None  # worker processes for the extraction, None for one per core and 1 to run serially
+cache_dir = "Data/cache"  # None to always recompute
+per_patient_cache = False  # cache every case on its own, to only recompute the cases that changed
+store_path = "cohort_store"  # binary copy written by DataPreprocess.py, read instead of the CSV files when up to date
+chunksize = None  # rows per chunk to stream the follow-ups file in, for files larger than memory
+compact = False  # save X as a FeatureMatrix, of int8 range codes and float32 values
 
 exp_name = "exp1_Y2"
 
@@ -36,90 +40,11 @@ feature2range = {
 }
 ############################################################
 
-clinical_df = pd.read_csv(clinical_data_path)
-follow_ups_df = pd.read_csv(follow_ups_data_path)
+if __name__ == "__main__":
+    X, T, Y = extract_samples_cached(clinical_data_path, follow_ups_data_path, features, treatments, feature2range,
+                                     require_all_features=False, outcome="next_line_in_range_fraction",
+                                     n_jobs=n_jobs, cache_dir=cache_dir, per_patient=per_patient_cache,
+                                     store_path=store_path, chunksize=chunksize, compact=compact)
 
-cases = clinical_df["case_id"].unique()
-follow_ups = follow_ups_df["Follow-Up"].unique()
-markers = follow_ups_df["Laboratory Test"].unique()
-
-cases = [case for case in cases if case in follow_ups_df["Case ID"].unique()]
-clinical_df.set_index("case_id", inplace=True)
-follow_ups_df.set_index("Case ID", inplace=True)
-
-X, T, Y = [], [], []
-
-for ind in range(len(cases)):
-    case_id = cases[ind]
-    clinical_data = clinical_df.loc[case_id]
-    follow_ups_data = follow_ups_df.loc[case_id]
-
-    patient = Patient(clinical_data, follow_ups_data, case_id)
-    therapy_names = patient.get_line_of_therapy_names()
-    if len(therapy_names)<=1:
-        continue
-    for therapy_name, next_therapy_name in zip(therapy_names[:-1], therapy_names[1:]):
-        therapy = patient.get_follow_ups_before_line_of_therapy(therapy_name)
-        if len(therapy)==0:
-            therapy = patient.get_follow_ups_in_line_of_therapy(therapy_name)
-            if len(therapy)==0:
-                continue
-            latest_follow_up = therapy[0]
-        else:
-            latest_follow_up = therapy[-1]
-        t = patient.get_therapeutic_agents_in_line_of_therapy(therapy_name)
-
-        next_therapy = patient.get_follow_ups_before_line_of_therapy(next_therapy_name)
-        if len(next_therapy)==0:
-            next_therapy = patient.get_follow_ups_in_line_of_therapy(next_therapy_name)
-            if len(next_therapy)==0:
-                continue
-            next_latest_follow_up = next_therapy[0]
-        else:
-            next_latest_follow_up = next_therapy[-1]
-        ok, total = 0, 0
-        for feature in features:
-            val = next_latest_follow_up.marker2val(feature)
-            if val is None:
-                continue
-            else:
-                assert isinstance(val, float)
-                feature_range = feature2range[feature]
-                if feature_range[0]<=val<=feature_range[0]:
-                    ok += 1
-                total += 1
-        assert total>0
-        y = ok/total
-        
-        if patient.height>0 and patient.weight>0:
-            markers = set(latest_follow_up.markers)
-            
-            sample = [patient.height, patient.weight]
-            for feature in features:
-                val = latest_follow_up.marker2val(feature)
-                if val is None:
-                    val = 3
-                else:
-                    assert isinstance(val, float)
-                    feature_range = feature2range[feature]
-                    if val<feature_range[0]:
-                        val = 1
-                    elif val>feature_range[1]:
-                        val = 2
-                    else:
-                        val = 0
-                sample.append(val)
-            X.append(sample)
-            treatment = np.zeros((len(treatments),))
-            for t_ in t:
-                if t_ in treatments:
-                    treatment[treatments.index(t_)] = 1
-            T.append(treatment)
-            Y.append(y)
-
-X = np.array(X)
-T = np.array(T)
-Y = np.array(Y)
-
-os.makedirs("Data", exist_ok=True)
-np.savez(f"Data/{exp_name}", X=X, T=T, Y=Y)
\ No newline at end of file
+    os.makedirs("Data", exist_ok=True)
+    save_samples(f"Data/{exp_name}", X, T, Y)
\ No newline at end of file
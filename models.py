@@ -1,8 +1,24 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import clone
 from sklearn.linear_model import LogisticRegression, LinearRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from base_learners import ColumnStack, RowSelection
+from treatment_sets import encode_treatments, decode_treatments
 
 N = 10
 
+MAX_PROPENSITY_MODELS = 16
+_propensity_models = OrderedDict()  # the latest MAX_PROPENSITY_MODELS propensity models fitted in this process, by fingerprint
+_warm_start_models = {}  # the latest propensity model fitted in this process with every warm-start key
+
 class LinUCB:
     def __init__(self, n_features, n_treatments, alpha):
         self.n_features = n_features
@@ -10,6 +26,9 @@ class LinUCB:
         self.alpha = alpha
         self.A = np.array([np.identity(self.n_features) for i in range(self.n_treatments)])
         self.b = np.array([np.zeros((self.n_features)) for i in range(self.n_treatments)])
+        # inverse of A and theta = A^-1 b of every treatment, kept up to date by update() so scoring needs no inversion
+        self.A_inv = np.array([np.identity(self.n_features) for i in range(self.n_treatments)])
+        self.theta = np.array([np.zeros((self.n_features)) for i in range(self.n_treatments)])
         
     def choose_action(self, features):
         p = self.rewards(features)
@@ -18,64 +37,283 @@ class LinUCB:
     def update(self, features, reward, treatment):
         self.A[treatment] += np.outer(features, features.T)
         self.b[treatment] += reward * features
+        # Sherman-Morrison: (A + x x^T)^-1 = A^-1 - (A^-1 x)(A^-1 x)^T / (1 + x^T A^-1 x)
+        A_inv_x = self.A_inv[treatment].dot(features)
+        self.A_inv[treatment] -= np.outer(A_inv_x, A_inv_x) / (1 + features.dot(A_inv_x))
+        self.theta[treatment] = self.A_inv[treatment].dot(self.b[treatment])
+    
+    def add_treatments(self, n_treatments):
+        # new arms start from A = I and b = 0, like the arms of a new bandit
+        d = self.n_features
+        self.A = np.concatenate((self.A.reshape(-1, d, d), np.tile(np.identity(d), (n_treatments, 1, 1))))
+        self.b = np.concatenate((self.b.reshape(-1, d), np.zeros((n_treatments, d))))
+        self.A_inv = np.concatenate((self.A_inv.reshape(-1, d, d), np.tile(np.identity(d), (n_treatments, 1, 1))))
+        self.theta = np.concatenate((self.theta.reshape(-1, d), np.zeros((n_treatments, d))))
+        self.n_treatments += n_treatments
+    
+    def fit(self, X, T, Y):
+        # offline training on logged samples, same A and b as calling update() on every sample from the initial state
+        self.A = np.array([np.identity(self.n_features) for i in range(self.n_treatments)])
+        self.b = np.array([np.zeros((self.n_features)) for i in range(self.n_treatments)])
+        return self.partial_fit(X, T, Y)
+    
+    def partial_fit(self, X, T, Y):
+        # adds a chunk of samples: X^T X and X^T Y over the rows of every treatment, then one refresh for the chunk
+        order = np.argsort(T, kind='stable')
+        X, T, Y = X[order], T[order], Y[order]
+        treatments, starts = np.unique(T, return_index=True)
+        stops = np.append(starts[1:], len(T))
+        for treatment, start, stop in zip(treatments, starts, stops):
+            self.A[treatment] += X[start:stop].T.dot(X[start:stop])
+            self.b[treatment] += Y[start:stop].dot(X[start:stop])
+        self.refresh()
+        return self
+    
+    def refresh(self):
+        # recompute A^-1 and theta from A and b, to drop the rounding errors accumulated by the rank-one updates
+        self.A_inv = np.linalg.inv(self.A)
+        self.theta = np.einsum('kij,kj->ki', self.A_inv, self.b)
     
     def rewards(self, features):
-        theta = [np.linalg.inv(self.A[i]).dot(self.b[i]) for i in range(self.n_treatments)]
-        p = np.array([theta[i].dot(features) + self.alpha * np.sqrt(features.dot(np.linalg.inv(self.A[i])).dot(features)) for i in range(self.n_treatments)])
-        return p
+        return self.rewards_batch(features[None, :])[0]
+    
+    def rewards_batch(self, X):
+        # [n, treatments] UCB of every sample and treatment
+        means, widths = self.means_and_widths(X)
+        return means + self.alpha * widths
+    
+    def rewards_sweep(self, X, alphas):
+        # [alphas, n, treatments] UCB for every alpha, the means and widths do not depend on alpha and are computed once
+        means, widths = self.means_and_widths(X)
+        return means[None, :, :] + np.asarray(alphas)[:, None, None] * widths[None, :, :]
+    
+    def means_and_widths(self, X):
+        # [n, treatments] posterior means and confidence widths, as two matrix products over the stacked arms:
+        # x^T A^-1 x is the dot product of the flattened x x^T and A^-1
+        means = X.dot(self.theta.T)
+        outer = (X[:, :, None] * X[:, None, :]).reshape(X.shape[0], -1)
+        widths = np.sqrt(outer.dot(self.A_inv.reshape(self.n_treatments, -1).T))
+        return means, widths
         
 def run_bandit_algorithm(data, treatments, rewards, n_treatments, alpha=0.1):
     n_samples, n_features = data.shape
     bandit = LinUCB(n_features, n_treatments, alpha)
     
-    for i in range(n_samples):
-        features = data[i, :n_features]
-        bandit.update(features, rewards[i], treatments[i])
+    bandit.fit(data[:, :n_features], treatments, rewards)
     
-    all_rewards = []
-    for i in range(n_samples):
-        features = data[i, :n_features]
-        all_rewards.append(bandit.rewards(features))
-    all_rewards = np.array(all_rewards)
+    all_rewards = bandit.rewards_batch(data[:, :n_features])
     
     return all_rewards.mean(0), all_rewards.argpartition(-N, axis=1)[:,-N:]
 
-def S_Learner(X, T, Y, n_treatments):
+def run_bandit_alpha_sweep(data, treatments, rewards, n_treatments, alphas):
+    # run_bandit_algorithm for every alpha, from a single fit: [alphas, treatments] rewards and [alphas, n, N] actions
+    n_samples, n_features = data.shape
+    bandit = LinUCB(n_features, n_treatments, alphas[0])
+    bandit.fit(data[:, :n_features], treatments, rewards)
+    
+    means, widths = bandit.means_and_widths(data[:, :n_features])
+    all_rewards = means.mean(0)[None, :] + np.asarray(alphas)[:, None] * widths.mean(0)[None, :]
+    actions = np.stack([(means + alpha * widths).argpartition(-N, axis=1)[:,-N:] for alpha in alphas])
+    
+    return all_rewards, actions
 
-    model = LinearRegression().fit(np.concatenate((X, T[:,None]), axis=1), Y)
+class BanditState:
+    # a LinUCB kept across runs, with the schema of its features, the treatments set of every arm (a multi-hot row
+    # over treatments) and the (case id, line of therapy) keys of the samples it was updated with
+    # saved as a directory of .npy files that load() can memory-map, and a state.json with the schema
+    def __init__(self, features, treatments, alpha):
+        self.features = list(features)
+        self.treatments = list(treatments)
+        self.bandit = LinUCB(len(self.features), 0, alpha)
+        self.treatments_sets = np.zeros((0, len(self.treatments)), dtype=np.uint8)
+        self.keys = np.zeros((0, 2), dtype=str)
     
-    actions = []
-    rewards = []
-    for i in range(n_treatments):
+    def get_arms(self, T):
+        # arm of every multi-hot row of T, adding an arm for every treatments set the bandit has not seen yet
+        # arms keep the order they were added in, so the codes of the sets are mapped through their sorted order
+        arm_codes = encode_treatments(self.treatments_sets)
+        codes, indices = np.unique(encode_treatments(T), return_inverse=True)
+        new_codes = codes[~np.isin(codes, arm_codes)]
+        if len(new_codes) > 0:
+            self.treatments_sets = np.concatenate((self.treatments_sets, decode_treatments(new_codes, len(self.treatments))))
+            self.bandit.add_treatments(len(new_codes))
+            arm_codes = np.concatenate((arm_codes, new_codes))
+        order = np.argsort(arm_codes)
+        return order[np.searchsorted(arm_codes[order], codes)][indices]
+    
+    def ingest(self, X, T, Y, keys):
+        # adds the samples whose keys were not ingested before, returns their number
+        # as one partial_fit, whose refresh recomputes A^-1 from A, so the saved A^-1 does not accumulate the rounding
+        # errors of the rank-one updates across runs
+        seen = set(map(tuple, self.keys.tolist()))
+        keys = np.asarray(keys).astype(str)
+        new = np.array([tuple(key) not in seen for key in keys.tolist()], dtype=bool)
+        if not new.any():
+            return 0
+        arms = self.get_arms(T[new])
+        self.bandit.partial_fit(X[new], arms, Y[new])
+        self.keys = np.concatenate((self.keys, keys[new]))
+        return int(new.sum())
+    
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        for name in ['A', 'b', 'A_inv', 'theta']:
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self.bandit, name))
+        np.save(os.path.join(path, 'treatments_sets.npy'), self.treatments_sets)
+        np.save(os.path.join(path, 'keys.npy'), self.keys)
+        with open(os.path.join(path, 'state.json'), 'w') as file:
+            json.dump({'features': self.features, 'treatments': self.treatments, 'alpha': self.bandit.alpha}, file)
+    
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        # mmap_mode='r' maps the arrays read-only, for scoring without ingesting
+        with open(os.path.join(path, 'state.json')) as file:
+            schema = json.load(file)
+        state = cls(schema['features'], schema['treatments'], schema['alpha'])
+        for name in ['A', 'b', 'A_inv', 'theta']:
+            setattr(state.bandit, name, np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode))
+        state.bandit.n_treatments = state.bandit.A.shape[0]
+        state.treatments_sets = np.load(os.path.join(path, 'treatments_sets.npy'), mmap_mode=mmap_mode)
+        state.keys = np.load(os.path.join(path, 'keys.npy'))
+        return state
+
+def predict_outcomes(X, coefs, intercepts):
+    # [n, treatments] counterfactual outcomes of linear outcome models stacked by treatment, in one matrix product:
+    # coefs [treatments, features] and intercepts [treatments], or coefs [1, features] for a model shared by all treatments
+    return X.dot(coefs.T) + intercepts[None, :]
 
-        prediction = model.predict(np.concatenate((X, np.full((X.shape[0],1), fill_value=i)), axis=1))
-        rewards.append(prediction.mean())
-        actions.append(prediction)
+def grouped_least_squares(X, T, Y, n_treatments, ridge=0.0):
+    # LinearRegression of Y on X over the rows of every treatment, from the normal equations of all treatments at once:
+    # X and Y are centered by the mean of their treatment and the per-treatment sums are one reduceat over the rows
+    # sorted by treatment, so the cost does not grow with n_treatments. Without ridge the minimum-norm solution is
+    # taken like sklearn does for treatments with fewer samples than features. Returns coefs [treatments, features]
+    # and intercepts [treatments], NaN intercepts for treatments without samples.
+    n_samples, n_features = X.shape
+    counts = np.bincount(T, minlength=n_treatments)
+    has_samples = counts > 0
+    x_means = np.zeros((n_treatments, n_features))
+    np.add.at(x_means, T, X)
+    x_means[has_samples] /= counts[has_samples, None]
+    y_means = np.full(n_treatments, np.nan)
+    y_means[has_samples] = np.bincount(T, weights=Y, minlength=n_treatments)[has_samples] / counts[has_samples]
     
-    actions = np.stack(actions, axis=1)
+    order = np.argsort(T, kind='stable')
+    starts = np.searchsorted(T[order], np.arange(n_treatments))[has_samples]
+    X_centered = X[order] - x_means[T[order]]
+    Y_centered = Y[order] - y_means[T[order]]
+    gram = np.zeros((n_treatments, n_features * n_features))
+    gram[has_samples] = np.add.reduceat((X_centered[:, :, None] * X_centered[:, None, :]).reshape(n_samples, -1), starts, axis=0)
+    gram = gram.reshape(n_treatments, n_features, n_features)
+    xy = np.zeros((n_treatments, n_features))
+    xy[has_samples] = np.add.reduceat(X_centered * Y_centered[:, None], starts, axis=0)
     
-    return rewards, actions.argpartition(-N, axis=1)[:,-N:]
+    if ridge > 0:
+        coefs = np.linalg.solve(gram + ridge * np.identity(n_features), xy[:, :, None])[:, :, 0]
+    else:
+        coefs = np.einsum('kij,kj->ki', np.linalg.pinv(gram, hermitian=True), xy)
+    return coefs, y_means - (x_means * coefs).sum(1)
 
-def T_Learner(X, T, Y, n_treatments):
+def _fit_clone(base_learner, X, Y):
+    return clone(base_learner).fit(X, Y)
 
-    actions = []
-    rewards = []
-    for i in range(n_treatments):
+def S_Learner(X, T, Y, n_treatments, base_learner=None):
+    # base_learner is a regressor to use instead of LinearRegression (see base_learners.py), fitted on X with the
+    # treatment index as a last feature that is appended chunk by chunk, so X may be memory-mapped
+    
+    if base_learner is None:
+        model = LinearRegression().fit(np.concatenate((X, T[:,None]), axis=1), Y)
+        
+        # the treatment index is the last feature, so it only shifts the intercept of every treatment
+        intercepts = model.intercept_ + model.coef_[-1] * np.arange(n_treatments)
+        actions = predict_outcomes(X, model.coef_[None, :-1], intercepts)
+    else:
+        model = clone(base_learner).fit(ColumnStack(X, T), Y)
+        actions = np.stack([model.predict(ColumnStack(X, np.full(X.shape[0], i))) for i in range(n_treatments)], axis=1)
+    rewards = actions.mean(0)
     
-        X_Ti = X[T==i]
-        Y_Ti = Y[T==i]
-        model = LinearRegression().fit(X_Ti, Y_Ti)
+    return rewards, actions.argpartition(-N, axis=1)[:,-N:]
 
-        prediction = model.predict(X)
-        rewards.append(prediction.mean())
-        actions.append(prediction)
+def T_Learner(X, T, Y, n_treatments, ridge=0.0, base_learner=None, n_jobs=1):
+    # base_learner is a regressor to use instead of least squares (see base_learners.py, or any sklearn regressor),
+    # cloned and fitted per treatment in n_jobs threads (None for one per core) on a RowSelection of the rows of the
+    # treatment, so X is not copied per treatment and may be memory-mapped
     
-    actions = np.stack(actions, axis=1)
+    if base_learner is None:
+        coefs, intercepts = grouped_least_squares(X, T, Y, n_treatments, ridge)
+        actions = predict_outcomes(X, coefs, intercepts)
+    else:
+        models = Parallel(n_jobs=n_jobs if n_jobs is not None else -1, prefer='threads')(
+            delayed(_fit_clone)(base_learner, RowSelection(X, np.flatnonzero(T==i)), Y[T==i]) for i in range(n_treatments))
+        actions = np.stack([model.predict(X) for model in models], axis=1)
+    rewards = actions.mean(0)
     
     return rewards, actions.argpartition(-N, axis=1)[:,-N:]
 
-def IPW(X, T, Y, n_treatments, max_iter=500):
-    model = LogisticRegression(max_iter=max_iter).fit(X, T)
+def get_propensity_fingerprint(X, T, max_iter):
+    sha = hashlib.sha256()
+    for array in (np.ascontiguousarray(X, dtype=float), np.ascontiguousarray(T, dtype=np.int64)):
+        sha.update(str(array.shape).encode())
+        sha.update(array.tobytes())
+    sha.update(str(max_iter).encode())
+    return sha.hexdigest()
+
+def _save_propensity_model(path, model):
+    np.savez(path, classes=model.classes_, coef=model.coef_, intercept=model.intercept_)
+
+def _load_propensity_model(path, max_iter):
+    npzfile = np.load(path)
+    model = LogisticRegression(max_iter=max_iter)
+    model.classes_, model.coef_, model.intercept_ = npzfile["classes"], npzfile["coef"], npzfile["intercept"]
+    model.n_features_in_ = model.coef_.shape[1]
+    return model
+
+def _get_warm_start_path(cache_dir, warm_start_key):
+    return os.path.join(cache_dir, 'warm_start_' + hashlib.sha256(str(warm_start_key).encode()).hexdigest() + '.npz')
+
+def _get_warm_start_model(X, T, max_iter, cache_dir, warm_start_key):
+    # the latest propensity model fitted with warm_start_key, in this process or else in cache_dir, if it has the
+    # same features and treatments
+    model = _warm_start_models.get(warm_start_key)
+    if model is None and cache_dir is not None and os.path.exists(_get_warm_start_path(cache_dir, warm_start_key)):
+        model = _load_propensity_model(_get_warm_start_path(cache_dir, warm_start_key), max_iter)
+    if model is not None and model.coef_.shape[1] == X.shape[1] and np.array_equal(model.classes_, np.unique(T)):
+        return model
+    return None
+
+def fit_propensity_model(X, T, max_iter=500, cache_dir=None, warm_start_key=None):
+    # LogisticRegression(max_iter).fit(X, T), fitted once per (X, T, max_iter) and cached in memory and in cache_dir
+    # (None for memory only). With warm_start_key, naming the sample set (e.g. the experiment), a new fit starts from
+    # the coefficients of the latest model fitted with the same key, so refits after a few samples change converge
+    # in a few iterations. The result then depends on that model, so without a key every fit starts from zero.
+    fingerprint = get_propensity_fingerprint(X, T, max_iter)
+    path = os.path.join(cache_dir, f'{fingerprint}.npz') if cache_dir is not None else None
+    if fingerprint in _propensity_models:
+        model = _propensity_models[fingerprint]
+        _propensity_models.move_to_end(fingerprint)
+    elif path is not None and os.path.exists(path):
+        model = _load_propensity_model(path, max_iter)
+    else:
+        model = LogisticRegression(max_iter=max_iter)
+        previous = _get_warm_start_model(X, T, max_iter, cache_dir, warm_start_key) if warm_start_key is not None else None
+        if previous is not None:
+            model.set_params(warm_start=True)
+            model.coef_, model.intercept_ = previous.coef_.copy(), previous.intercept_.copy()
+        model.fit(X, T)
+        if path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            _save_propensity_model(path, model)
+    _propensity_models[fingerprint] = model
+    if len(_propensity_models) > MAX_PROPENSITY_MODELS:
+        _propensity_models.popitem(last=False)
+    if warm_start_key is not None and _warm_start_models.get(warm_start_key) is not model:
+        _warm_start_models[warm_start_key] = model
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            _save_propensity_model(_get_warm_start_path(cache_dir, warm_start_key), model)
+    return model
+
+def IPW(X, T, Y, n_treatments, max_iter=500, cache_dir=None, warm_start_key=None):
+    model = fit_propensity_model(X, T, max_iter, cache_dir, warm_start_key)
     
     probs = model.predict_proba(X) # [n,treatments]
 
@@ -87,6 +325,71 @@ def IPW(X, T, Y, n_treatments, max_iter=500):
 
     return rewards
 
+def _fit_fold(X, T, Y, folds, fold, n_treatments, max_iter):
+    # outcome models (grouped least squares per treatment) and propensity model fitted on the samples outside the fold,
+    # returns their [fold samples, treatments] predictions on the samples of the fold
+    # treatments without training samples get NaN outcomes (the NaN intercepts of grouped_least_squares), and the
+    # ones with too few samples for a stable linear fit (under twice its parameters) their mean training outcome
+    train, test = folds!=fold, folds==fold
+    coefs, intercepts = grouped_least_squares(X[train], T[train], Y[train], n_treatments)
+    outcomes = predict_outcomes(X[test], coefs, intercepts)
+    counts = np.bincount(T[train], minlength=n_treatments)
+    few_samples = (counts > 0) & (counts < 2 * (X.shape[1] + 1))
+    sums = np.bincount(T[train], weights=Y[train], minlength=n_treatments)
+    outcomes[:, few_samples] = (sums[few_samples] / counts[few_samples])[None, :]
+    # the features are standardized, heights and marker values are on very different scales
+    model = make_pipeline(StandardScaler(), LogisticRegression(max_iter=max_iter)).fit(X[train], T[train])
+    propensities = np.zeros((test.sum(), n_treatments))
+    propensities[:, model.classes_] = model.predict_proba(X[test])
+    return outcomes, propensities
+
+def _fit_fold_shared(X_name, X_shape, X_dtype, *args):
+    # _fit_fold in a worker process, with X read from the shared memory block X_name instead of a pickled copy
+    X_memory = shared_memory.SharedMemory(name=X_name)
+    try:
+        X = np.ndarray(X_shape, dtype=X_dtype, buffer=X_memory.buf)
+        return _fit_fold(X, *args)
+    finally:
+        del X
+        X_memory.close()
+
+def AIPW(X, T, Y, n_treatments, n_folds=5, max_iter=500, min_propensity=0.01, n_jobs=1, seed=0):
+    # doubly robust (augmented IPW) rewards with n_folds cross-fitting: the outcome and propensity models of every
+    # sample are fitted on the other folds, the folds serially or in n_jobs worker processes (None for one per fold)
+    # that share X through shared memory. Propensities are clipped to min_propensity, and the correction
+    # of every treatment is normalized by its sum of weights (Hajek), so the weights of small treatment sets do not
+    # blow up the estimate. Treatments missing from the training samples of any fold get NaN.
+    folds = np.random.default_rng(seed).permutation(X.shape[0]) % n_folds
+    args = [(T, Y, folds, fold, n_treatments, max_iter) for fold in range(n_folds)]
+    if n_jobs == 1:
+        results = [_fit_fold(X, *fold_args) for fold_args in args]
+    else:
+        X = np.ascontiguousarray(X)
+        X_memory = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+        try:
+            np.ndarray(X.shape, dtype=X.dtype, buffer=X_memory.buf)[:] = X
+            with ProcessPoolExecutor(max_workers=min(n_jobs or n_folds, n_folds)) as executor:
+                results = list(executor.map(_fit_fold_shared, *zip(*[(X_memory.name, X.shape, X.dtype) + fold_args for fold_args in args])))
+        finally:
+            X_memory.close()
+            X_memory.unlink()
+    
+    outcomes = np.zeros((X.shape[0], n_treatments))
+    propensities = np.zeros((X.shape[0], n_treatments))
+    for fold, (fold_outcomes, fold_propensities) in enumerate(results):
+        outcomes[folds==fold] = fold_outcomes
+        propensities[folds==fold] = fold_propensities
+    propensities = np.maximum(propensities, min_propensity)
+    
+    treated = T[:,None] == np.arange(n_treatments)[None, :]
+    weights = treated / propensities
+    residuals = np.where(treated, Y[:,None] - outcomes, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corrections = (weights * residuals).sum(0) / weights.sum(0)
+    rewards = outcomes.mean(0) + corrections
+    
+    return rewards
+
 if __name__=="__main__":
     n_examples = 100
     n_treatments = 15
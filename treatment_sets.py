@@ -0,0 +1,82 @@
+import numpy as np
+
+# A treatments set is a multi-hot row over the agents of a line of therapy. It is coded as an integer with a bit per
+# agent, the first agent in the most significant bit, so sorting the codes sorts the sets like np.unique(T, axis=0)
+# and set indices are the same as the ones of the unique rows.
+
+MAX_AGENTS = 32
+
+def encode_treatments(T):
+    # [n] uint32 code of every multi-hot row of T [n, agents]
+    T = np.asarray(T)
+    if T.shape[1] > MAX_AGENTS:
+        raise ValueError(f"at most {MAX_AGENTS} agents fit in a code, got {T.shape[1]}")
+    bits = np.left_shift(np.uint32(1), np.arange(T.shape[1] - 1, -1, -1, dtype=np.uint32))
+    return (T != 0).astype(np.uint32).dot(bits)
+
+def decode_treatments(codes, n_agents):
+    # [n, agents] uint8 multi-hot rows of codes [n]
+    bits = np.left_shift(np.uint32(1), np.arange(n_agents - 1, -1, -1, dtype=np.uint32))
+    return ((np.asarray(codes, dtype=np.uint32)[:, None] & bits[None, :]) != 0).astype(np.uint8)
+
+def pack_treatments(T):
+    # [n, ceil(agents / 8)] uint8 multi-hot rows of T [n, agents] packed 8 agents to a byte, the first agent in the
+    # most significant bit of the first byte
+    return np.packbits(np.asarray(T) != 0, axis=1)
+
+def unpack_treatments(packed, n_agents, dtype=np.uint8):
+    # [n, agents] multi-hot rows of pack_treatments rows
+    return np.unpackbits(np.asarray(packed, dtype=np.uint8), axis=1, count=n_agents).astype(dtype)
+
+def encode_packed_treatments(packed, n_agents):
+    # [n] encode_treatments codes of pack_treatments rows, without unpacking them
+    packed = np.asarray(packed, dtype=np.uint8)
+    if n_agents > MAX_AGENTS:
+        raise ValueError(f"at most {MAX_AGENTS} agents fit in a code, got {n_agents}")
+    # the bytes are the big-endian code followed by the padding bits of the last byte
+    byte_weights = np.left_shift(np.uint64(1), np.arange(8 * packed.shape[1] - 8, -8, -8, dtype=np.uint64))
+    codes = packed.astype(np.uint64).dot(byte_weights) >> np.uint64(8 * packed.shape[1] - n_agents)
+    return codes.astype(np.uint32)
+
+class TreatmentSets:
+    # the treatments sets seen in the data, indexed in the order of their codes, to map between the multi-hot rows
+    # of the samples, their set indices (the treatments of the estimators) and the names of the agents of a set
+    def __init__(self, agents, codes=()):
+        self.agents = list(agents)
+        self.codes = np.unique(np.asarray(codes, dtype=np.uint32))
+    
+    def __len__(self):
+        return len(self.codes)
+    
+    def encode(self, T, packed=False):
+        # [n] codes of the multi-hot rows of T, or of its pack_treatments rows with packed
+        return encode_packed_treatments(T, len(self.agents)) if packed else encode_treatments(T)
+    
+    def fit_transform(self, T, packed=False):
+        # sets of the rows of T [n, agents], returns the [n] set index of every row
+        self.codes, indices = np.unique(self.encode(T, packed), return_inverse=True)
+        return indices
+    
+    def transform(self, T, packed=False):
+        # [n] set index of every row of T, raises ValueError for a set that was not fitted
+        codes = self.encode(T, packed)
+        indices = np.searchsorted(self.codes, codes)
+        unknown = self.codes[np.minimum(indices, len(self.codes) - 1)] != codes if len(self.codes) > 0 else codes == codes
+        if unknown.any():
+            raise ValueError(f"unknown treatments sets: {self.names(codes=codes[unknown][:5])}")
+        return indices
+    
+    def inverse_transform(self, indices):
+        # [n, agents] multi-hot rows of set indices [n]
+        return decode_treatments(self.codes[indices], len(self.agents))
+    
+    @property
+    def sets(self):
+        # [sets, agents] multi-hot row of every set
+        return decode_treatments(self.codes, len(self.agents))
+    
+    def names(self, indices=None, codes=None):
+        # agent names of every set, or of the given set indices or codes
+        if codes is None:
+            codes = self.codes if indices is None else self.codes[indices]
+        return [[self.agents[j] for j in row.nonzero()[0]] for row in decode_treatments(codes, len(self.agents))]
\ No newline at end of file
@@ -0,0 +1,41 @@
+from CohortStore import load_cohort_store
+from FeatureExtraction import extract_samples
+from models import BanditState
+import numpy as np
+import os
+
+############################################################
+clinical_data_path = "clinical_sorted.csv"
+follow_ups_data_path = "follow_ups_data.csv"
+store_path = "cohort_store"  # binary copy written by DataPreprocess.py, read instead of the CSV files when up to date
+n_jobs = None  # worker processes for the extraction, None for one per core and 1 to run serially
+
+bandit_path = "Data/exp1_bandit"  # bandit state, created on the first run and updated with the new samples after it
+
+alpha = 0.1
+
+features = ['Albumin', 'Calcium', 'Total Protein', 'Creatinine', 'Immunoglobulin A', 'Absolute Neutrophil', 'Serum Free Immunoglobulin Light Chain, Kappa', 'Serum Free Immunoglobulin Light Chain, Lambda', 'M Protein', 'Immunoglobulin G', 'Leukocytes', 'Immunoglobulin M', 'Hemoglobin', 'Blood Urea Nitrogen', 'Glucose', 'Platelets']
+treatments = ['Bortezomib', 'Ixazomib', 'Panobinostat', 'Carmustine', 'Carfilzomib', 'Lenalidomide', 'Dexamethasone', 'Melphalan', 'Cyclophosphamide', 'Bendamustine', 'Prednisone', 'Thalidomide', 'Pomalidomide', 'Elotuzumab', 'Other', 'Daratumumab', 'Doxorubicin']
+############################################################
+
+if __name__ == "__main__":
+    store = load_cohort_store(clinical_data_path, follow_ups_data_path, store_path)
+    X, T, Y, keys = extract_samples(store, features, treatments, n_jobs=n_jobs, return_keys=True)
+    print("number of samples:", X.shape[0])
+
+    if X.shape[0] > 0:
+        good_lines = ~np.isnan(X).any(1)
+        X, T, Y, keys = X[good_lines], T[good_lines].astype(int), Y[good_lines], keys[good_lines]
+
+    schema = ["Patient Height", "Patient Weight"] + features
+    if os.path.exists(bandit_path):
+        state = BanditState.load(bandit_path)
+        if state.features != schema or state.treatments != treatments:
+            raise ValueError(f"{bandit_path} was trained on other features or treatments")
+    else:
+        state = BanditState(schema, treatments, alpha)
+
+    if X.shape[0] > 0:
+        print("new samples:", state.ingest(X, T, Y, keys))
+    print("treatments sets:", state.treatments_sets.shape[0])
+    state.save(bandit_path)
\ No newline at end of file